@@ -2,18 +2,43 @@ import streamlit as st
 import google.generativeai as genai
 import openai
 import os
-from components import chat_bots, image_searchings, food_suggestions, image_detection
+from components import chat_bots, image_searchings, food_suggestions, image_detection, chat_context, rate_limits, json_repair, scheduler, request_context, nutrition, speculation, jobs, circuit_breaker, router, load_shedding, metering, credentials, faq_cache, food_search, dish_catalog, dish_names
 from dotenv import load_dotenv
 import json
 import requests
 from PIL import Image, ImageOps
 from io import BytesIO
+import uuid
+import time
+from contextlib import contextmanager
+from concurrent.futures import as_completed
 
 load_dotenv()
 
 # Set your API keys
 openai.api_key = os.environ.get("OPEN_AI_API_KEY")
 
+# Plans from earlier batch runs give the dish catalog a head start
+dish_catalog.seed()
+
+# Stable id for this browser session, used to key per-user state in the components
+if 'session_id' not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
+
+@contextmanager
+def queued_request():
+    # Tags component calls with this session and shows the queue position while they wait
+    placeholder = st.empty()
+
+    def show_position(position):
+        placeholder.info(f"⏳ Lots of people are using SarrMal right now. You are number {position} in line...")
+
+    try:
+        with request_context.use(session_id=st.session_state.session_id, on_queue_wait=show_position):
+            yield
+    finally:
+        placeholder.empty()
+
 # Function to generate a food suggestion using Gemini model
 def generate_food_suggestion_gemini(prompt):
     return food_suggestions.generate_gemini_v3(prompt)
@@ -22,25 +47,35 @@ def generate_food_suggestion_gemini(prompt):
 def generate_food_suggestion_openai(prompt):
     return food_suggestions.generate_openai(prompt)
 
+def generate_plan(plan_format, prompt):
+    # The backend is picked when the plan is generated, so auto mode decides per request
+    provider = provider_choice()
+    if plan_format.startswith("Quick"):
+        return food_suggestions.generate_skeleton(prompt, provider)
+    if plan_format.startswith("Compact"):
+        return food_suggestions.generate_compact(prompt, provider)
+    if provider == "sarrmal":
+        return generate_food_suggestion_gemini(prompt)
+    return generate_food_suggestion_openai(prompt)
+
 # Function to fetch an image from Unsplash
 def fetch_food_image(food_name):
-    if image_engine == "Google":
-        return image_searchings.fetch_google(food_name)
-    else:
-        return image_searchings.fetch_unsplash(food_name)
+    try:
+        return image_searchings.fetch_cached(food_name, image_engine)
+    except rate_limits.RateLimitExceeded:
+        st.warning("⏳ Image search is busy right now, skipping this picture.")
+        return None
 
 def load_image(url):
     try:
-        response = requests.get(url)
-        response.raise_for_status()  # Check if the request was successful
-        content_type = response.headers['Content-Type']
+        content = image_searchings.download_image(url)
         
         # Check if the content is an image
-        if 'image' not in content_type:
+        if content is None:
             st.warning("⚠️ The URL does not point to a valid image.")
             return None
         
-        img = Image.open(BytesIO(response.content))
+        img = Image.open(BytesIO(content))
         return img
     except requests.exceptions.RequestException as e:
         st.warning(f"😔 Oops! Failed to retrieve the web image.")
@@ -52,7 +87,60 @@ def load_image(url):
 def resize_to_square(image, size=(512, 400)):
     return ImageOps.fit(image, size, Image.Resampling.LANCZOS)
 
-def display_meal_plan(response):
+def display_dish(label, dish, key):
+    st.write(f"**{label}:** {dish.get('name')}")
+    image_url = None
+    if image_searchings.is_cached(dish.get('name'), image_engine):
+        image_url = fetch_food_image(dish.get('name'))
+    elif load_shedding.is_lite():
+        pass  # no image searches while the service is overloaded, pictures come back once it recovers
+    elif st.session_state.get("lazy_images"):
+        # The plan ran short of time before this picture was found, so it loads on request
+        if st.button("🖼️ Show picture", key=f"picture_{key}"):
+            image_url = fetch_food_image(dish.get('name'))
+    else:
+        image_url = fetch_food_image(dish.get('name'))
+    
+    if image_url:
+        image = load_image(image_url)
+        if image:
+            square_img = resize_to_square(image)
+            st.image(square_img, caption=dish.get('name'), use_column_width=True)
+        # else:
+        #     st.write("🚫 Oops! No image found for this food.")
+        
+    st.write(f"- Calories: {dish.get('calories')} kcal")
+    st.write(f"- Category: {dish.get('category')}")
+    
+    if dish.get('how_to_cook') is None:
+        # Quick plans leave the details out until the user asks for them
+        if st.button("📖 Show ingredients & how to cook", key=f"details_{key}"):
+            with st.spinner("Loading cooking details..."), queued_request():
+                details = food_suggestions.get_dish_details(dish.get('name'), provider_choice())
+            if details:
+                dish.update(details)
+    
+    if dish.get('how_to_cook') is not None:
+        ingredients = ', '.join(dish.get('ingredients', []))
+        st.write(f"- Ingredients: {ingredients}")
+        
+        st.write(f"- How to Cook: {dish.get('how_to_cook')}")
+    st.write(f"- Meal Time: {dish.get('meal_time')}")
+
+def display_swap(response, meal_time, slot, key, prompt, allergies):
+    # Lets the user replace one dish; the rest of the plan and its images stay as they are
+    dish = response['response'][meal_time][slot]
+    found = food_suggestions.find_allergens(dish, allergies)
+    if found:
+        st.warning(f"⚠️ This dish may contain {', '.join(found)}. You may want to swap it.")
+    if st.button("🔄 Swap this dish", key=f"swap_{key}"):
+        with st.spinner("Finding another dish..."), queued_request():
+            new_dish = food_suggestions.regenerate_slot(response, meal_time, slot, prompt, provider_choice())
+        if new_dish:
+            response['response'][meal_time][slot] = new_dish
+            st.rerun()
+
+def display_meal_plan(response, key="", prompt=None, allergies=()):
     if response:
         st.subheader("Meal Plan")
         for meal_time, meal_info in response['response'].items():
@@ -65,59 +153,213 @@ def display_meal_plan(response):
             with col1:
                 main_dish = meal_info.get("main_dish", {})
                 if main_dish:
-                    st.write(f"**Main Dish:** {main_dish.get('name')}")
-                    image_url = fetch_food_image(main_dish.get('name'))
-                    
-                    if image_url:
-                        # st.image(image_url, caption=main_dish.get('name'), use_column_width=True)
-                        image = load_image(image_url)
-                        if image:
-                            square_img = resize_to_square(image)
-                            st.image(square_img, caption=main_dish.get('name'), use_column_width=True)
-                        # else:
-                        #     st.write("🚫 Oops! No image found for this food.")
-                        
-                         
-                    st.write(f"- Calories: {main_dish.get('calories')} kcal")
-                    st.write(f"- Category: {main_dish.get('category')}")
-                    
-                    ingredients = ', '.join(main_dish.get('ingredients', []))
-                    st.write(f"- Ingredients: {ingredients}")
-                    
-                    st.write(f"- How to Cook: {main_dish.get('how_to_cook')}")
-                    st.write(f"- Meal Time: {main_dish.get('meal_time')}")
+                    display_dish("Main Dish", main_dish, f"{key}_{meal_time}_main_dish")
+                    if prompt:
+                        display_swap(response, meal_time, "main_dish", f"{key}_{meal_time}_main_dish", prompt, allergies)
             
             # Display side dish in the second column
             with col2:
                 side_dish = meal_info.get("side_dish", {})
                 if side_dish:
-                    st.write(f"**Side Dish:** {side_dish.get('name')}")
-                    image_url = fetch_food_image(side_dish.get('name'))
-                                        
-                    if image_url:
-                        # st.image(image_url, caption=side_dish.get('name'), use_column_width=True)
-                        image = load_image(image_url)
-                        if image:
-                            square_img = resize_to_square(image)
-                            st.image(square_img, caption=side_dish.get('name'), use_column_width=True)
-                        # else:
-                        #     st.write("🚫 Oops! No image found for this food.")
-                            
-                    st.write(f"- Calories: {side_dish.get('calories')} kcal")
-                    st.write(f"- Category: {side_dish.get('category')}")
-                    
-                    ingredients = ', '.join(side_dish.get('ingredients', []))
-                    st.write(f"- Ingredients: {ingredients}")
-                    
-                    st.write(f"- How to Cook: {side_dish.get('how_to_cook')}")
-                    st.write(f"- Meal Time: {side_dish.get('meal_time')}")
+                    display_dish("Side Dish", side_dish, f"{key}_{meal_time}_side_dish")
+                    if prompt:
+                        display_swap(response, meal_time, "side_dish", f"{key}_{meal_time}_side_dish", prompt, allergies)
             
             st.write("\n")
 
+def display_food_search(result, stage=None):
+    # Shows one stage of a "Search your own Food" result, or all of them when stage is None
+    if stage in (None, "description"):
+        response = result.get("description")
+        if response:
+            for label, field in (("📏 Portion Size", "portion_size"), ("🔥 Calories Estimate", "calories_estimate"),
+                                 ("🏷️ Categories", "categories"), ("🕒 Meal Time", "meal_time"),
+                                 ("🌍 Cuisine", "cuisine"), ("🛒 Ingredients", "ingredients")):
+                value = response.get(field)
+                if value:
+                    st.markdown(f"**{label}**: {', '.join(map(str, value)) if isinstance(value, list) else value}")
+            how_to_cook = response.get("how_to_cook")
+            if how_to_cook:
+                st.write("**👨‍🍳 How to Cook:**")
+                for step in how_to_cook if isinstance(how_to_cook, list) else [how_to_cook]:
+                    st.markdown(f"- {step}")
+            for title, items, name_field in (("🍽️ Recommended Sides", response.get("recommended_sides"), "side_name"),
+                                             ("🥤 Recommended Drinks", response.get("recommended_drinks"), "drink_name")):
+                if items:
+                    st.write(f"**{title}:**")
+                    for item in items:
+                        if isinstance(item, dict):
+                            st.markdown(f"- **{item.get(name_field)}**: _{item.get('description', '')}_")
+                        else:
+                            st.markdown(f"- {item}")
+            if response.get("notes"):
+                st.markdown(f"**📝 Notes**: {response.get('notes')}")
+        elif "description" in result:
+            st.write("😔 No description is available for this dish.")
+    if stage in (None, "picture") and result.get("picture"):
+        try:
+            st.image(resize_to_square(Image.open(BytesIO(result["picture"]))), caption="Reference picture")
+        except IOError:
+            st.warning("❌ Sorry, we couldn't open the image.")
+    if stage in (None, "timings"):
+        timings = result["timings"]
+        st.caption(" · ".join(f"{name} {timings[name]:.1f}s" for name in food_search.STAGES if name in timings))
+
+def provider_choice(feature="meal_plan"):
+    # In auto mode every request goes to whichever backend is answering fastest right now
+    if model_choice == "Auto (fastest)":
+        return router.choose(feature)
+    return "sarrmal" if model_choice == "SarrMal (Tuning)" else "openai"
+
+# How often the page reruns to check on a background job
+JOB_POLL_SECONDS = 1.0
+
+# Time budget from the click to a finished plan. Generation gets most of it and
+# the pictures share what is left; pictures that don't fit load when clicked.
+PLAN_DEADLINE_SECONDS = 45.0
+GENERATION_SHARE = 0.75
+MIN_IMAGE_SECONDS = 3.0
+
+def prefetch_images(job, plans, engine):
+    # Warms the image caches so the page renders the finished plan without waiting on searches.
+    # Returns False if the deadline left some pictures out.
+    dishes = [
+        dish
+        for plan in plans.values()
+        for meal in ((plan or {}).get('response') or {}).values()
+        for dish in (meal or {}).values()
+    ]
+    for done, dish in enumerate(dishes):
+        job.check()
+        left = request_context.remaining()
+        if left is not None and left < MIN_IMAGE_SECONDS:
+            return False
+        # Each remaining picture gets an equal share of the time left
+        share = 1 / (len(dishes) - done)
+        if left is not None and left * share < request_context.MIN_CALL_SECONDS:
+            return False  # too short for a search, the page loads the rest when they are clicked
+        try:
+            with request_context.stage(share):
+                image_url = image_searchings.fetch_cached(dish.get('name'), engine)
+                if image_url:
+                    image_searchings.download_image(image_url)
+        except request_context.DeadlineExceeded:
+            return False  # the plan is ready, so the pictures left load lazily instead of failing the job
+        except (rate_limits.RateLimitExceeded, requests.exceptions.RequestException):
+            continue  # the page tries again for this picture when it renders
+    return True
+
+def catalog_plans(members):
+    # Plans for every member from the dish catalog, or None if any member needs the model
+    plans = {}
+    for member_id, (member_profile, target_calories) in members.items():
+        plans[member_id] = dish_catalog.catalog.plan(member_profile, target_calories)
+        if plans[member_id] is None:
+            return None
+    return plans
+
+def meal_plan_job(job, profiles, plan_format, prompt, speculation_key, engine, cache_key, members, from_catalog):
+    # Runs in the job pool: the plan first, then the pictures for its dishes
+    lite = load_shedding.is_lite()
+    if from_catalog:
+        # Known dishes that fit the profile take milliseconds and no model call
+        plans = catalog_plans(members)
+        if plans is not None:
+            notice = "📚 This plan was put together from dishes SarrMal has planned before."
+            if lite:
+                return {"plans": plans, "lazy_images": True, "notice": notice}
+            job.set_stage("Finding pictures of the dishes...")
+            return {"plans": plans, "lazy_images": not prefetch_images(job, plans, engine), "notice": notice}
+    job.set_stage("Generating food suggestion...")
+    metering.enforce()  # over today's budget: the job fails with the limit message
+    frugal = metering.should_downgrade()
+    if (lite or frugal) and food_suggestions.cached_plan(cache_key):
+        # Overloaded or near the budget: a plan already made for these details beats a new one
+        if lite:
+            notice = "🪶 SarrMal is very busy, so here is the last plan made for these details."
+        else:
+            notice = "💰 You're close to today's usage limit, so here is the last plan made for these details."
+        return {"plans": food_suggestions.cached_plan(cache_key), "lazy_images": lite, "notice": notice}
+    if lite or frugal:
+        plan_format = "Compact"  # far fewer output tokens than the full format
+    try:
+        with request_context.stage(GENERATION_SHARE):
+            if profiles:
+                # One request for the whole household, per-member retries for any plan that fails checks
+                plans = food_suggestions.generate_household(profiles, provider_choice())
+            else:
+                # A speculative run for these exact inputs may already have the plan
+                response = None
+                if speculation_key:
+                    timeout = request_context.timeout(speculation.TAKE_TIMEOUT_SECONDS)
+                    response = speculation.take(job.session_id, speculation_key, timeout)
+                if response is None:
+                    job.check()
+                    response = generate_plan(plan_format, prompt)
+                plans = {"": response}
+    except request_context.DeadlineExceeded:
+        plans = {}
+    job.check()
+
+    notice = None
+    if plans and all(plans.values()):
+        food_suggestions.remember_plan(cache_key, plans)
+        if plan_format == "Full":
+            for member_id, plan in plans.items():
+                dish_catalog.catalog.add_plan(plan, members[member_id][0])
+    elif food_suggestions.cached_plan(cache_key):
+        plans = food_suggestions.cached_plan(cache_key)
+        notice = "⌛ A new plan couldn't be made in time, so here is the last plan made for these details."
+    elif not plans:
+        raise request_context.DeadlineExceeded("The meal plan ran out of time")
+
+    if lite:
+        return {"plans": plans, "lazy_images": True, "notice": notice}  # no image searches while overloaded
+    job.set_stage("Finding pictures of the dishes...")
+    all_images = prefetch_images(job, plans, engine)
+    return {"plans": plans, "lazy_images": not all_images, "notice": notice}
+
+def profile_form(member=0):
+    # The "Your Details" inputs, keyed per household member
+    key = f"_{member}"
+    weight = st.number_input("Weight (kg)", min_value=1, max_value=300, value=70, key="weight" + key)
+    height = st.number_input("Height (cm)", min_value=30, max_value=250, value=175, key="height" + key)
+    age = st.number_input("Age", min_value=1, max_value=120, value=25, key="age" + key)
+    gender = st.selectbox("Gender", ["Male", "Female", "Other"], key="gender" + key)
+    exercise = st.selectbox("Exercise Level", ["None", "Light", "Moderate", "Intense"], key="exercise" + key)
+    diseases = st.multiselect("List any diseases", ["None", "Diabetes", "Hypertension"], default=["None"], key="diseases" + key)
+    allergies = st.multiselect("List any allergies", ["None", "Peanuts", "Shellfish", "Milk"], default=["None"], key="allergies" + key)
+    preferred_food = st.selectbox("Preferred Food", ["Burmese", "Chinese", "Western", "Japanese", "Korean", "Indian", "Other"], key="preferred" + key)
+    food_type = st.selectbox(
+        "Food Type",
+        [
+            "Vegetarian",
+            "Non-Vegetarian",
+            "Balanced",
+            "Other"
+        ],
+        key="food_type" + key
+    )
+    return {
+        "weight": weight,
+        "height": height,
+        "age": age,
+        "diseases": diseases,
+        "allergies": allergies,
+        "gender": gender,
+        "exercise": exercise,
+        "preferred": preferred_food,
+        "food-type": food_type
+    }
+
 
 # Streamlit app layout
 st.title("AI-Powered Food Suggestion System Demo")
 
+if load_shedding.is_lite():
+    st.warning("🪶 SarrMal is very busy right now, so it is running in lite mode: compact plans, "
+               "no dish pictures and shorter chat replies until things calm down.")
+
 # Sidebar for selecting functionality
 functionality_choice = st.sidebar.selectbox(
     "Choose Functionality",
@@ -125,7 +367,7 @@ functionality_choice = st.sidebar.selectbox(
 )
 
 # Toggle for selecting the AI model
-model_choice = st.sidebar.radio("Choose the AI model", options=["SarrMal (Tuning)", "OpenAI (GPT-4)"])
+model_choice = st.sidebar.radio("Choose the AI model", options=["SarrMal (Tuning)", "OpenAI (GPT-4)", "Auto (fastest)"])
 st.sidebar.write("🌟 Please note that the OpenAI model is currently in beta and may occasionally produce results that are not entirely accurate.")
 st.sidebar.write("🌟 Additionally, the format for ingredients may vary slightly between models.")
 if st.sidebar.radio("Choose Image Generator", options=["Unsplash", "Google"]) == "Google":
@@ -135,12 +377,57 @@ else:
     image_engine = "Unsplash"
     # st.write("Unsplash Image Searching is Active.")
 st.sidebar.write("📓 Please note that the Google Image Generator is currently in beta and may occasionally produce results that are not entirely accurate.")
+from_catalog = st.sidebar.checkbox(
+    "📚 Reuse dishes SarrMal has planned before when they fit",
+    value=True,
+    help="Plans are put together instantly from earlier dishes that suit your details, and only generated when none fit."
+)
+speculative = st.sidebar.checkbox(
+    "🔮 Start preparing my plan while I fill in the form",
+    help="Generates in the background once your details stop changing, so the plan is often ready when you click."
+)
+
+# Process-wide counters shared by every session, for keeping an eye on load
+with st.sidebar.expander("📊 Service metrics"):
+    st.write("Token and cost metering (today)")
+    st.json(metering.get_stats())
+    st.download_button("Download usage summary (CSV)", metering.export_csv(), file_name="sarrmal_usage.csv", mime="text/csv")
+    st.write("Load shedding")
+    st.json(load_shedding.get_stats())
+    st.write("Backend latency and auto routing")
+    st.json(router.get_stats())
+    st.write("Circuit breakers")
+    st.json(circuit_breaker.get_stats())
+    st.write("Scheduler queues")
+    st.json(scheduler.get_stats())
+    st.write("Rate limit queue waits (seconds)")
+    st.json(rate_limits.get_wait_stats())
+    st.write("Background jobs")
+    st.json(jobs.get_stats())
+    st.write("Speculative generation")
+    st.json(speculation.get_stats())
+    st.write("Meal plan generation")
+    st.json(food_suggestions.get_plan_stats())
+    st.write("Model JSON parsing")
+    st.json(json_repair.get_stats())
+    st.write("OAuth credentials (auth latency, apart from model calls)")
+    st.json(credentials.manager.stats())
+    st.write("Food search stage timings (seconds)")
+    st.json(food_search.get_stats())
+    st.write("Dish name suggestions")
+    st.json(dish_names.index.stats())
+    st.write("Dish catalog")
+    st.json(dish_catalog.catalog.stats())
+    st.write("Chat FAQ cache")
+    st.json(faq_cache.get_stats())
 
 
 if functionality_choice == "Generate Meal Plan":
     st.write("Get personalized food suggestions!")
     if model_choice == "SarrMal (Tuning)":
         st.write("SarrMal (Tuning) model is Active.")
+    elif model_choice == "Auto (fastest)":
+        st.write("Auto mode is Active: each request goes to the model answering fastest right now.")
     else:
         st.write("OpenAI (GPT-4) model is Active.")
     # User input fields for generating the food suggestion prompt
@@ -149,36 +436,29 @@ if functionality_choice == "Generate Meal Plan":
     else:
         st.write("Unsplash Image Searching is Active.")
         
-    st.subheader("Your Details")
-    weight = st.number_input("Weight (kg)", min_value=1, max_value=300, value=70)
-    height = st.number_input("Height (cm)", min_value=30, max_value=250, value=175)
-    age = st.number_input("Age", min_value=1, max_value=120, value=25)
-    gender = st.selectbox("Gender", ["Male", "Female", "Other"])
-    exercise = st.selectbox("Exercise Level", ["None", "Light", "Moderate", "Intense"])
-    diseases = st.multiselect("List any diseases", ["None", "Diabetes", "Hypertension"], default=["None"])
-    allergies = st.multiselect("List any allergies", ["None", "Peanuts", "Shellfish", "Milk"], default=["None"])
-    preferred_food = st.selectbox("Preferred Food", ["Burmese", "Chinese", "Western", "Japanese", "Korean", "Indian", "Other"])
-    food_type = st.selectbox(
-        "Food Type",
-        [
-            "Vegetarian",
-            "Non-Vegetarian",
-            "Balanced",
-            "Other"
-        ]
-    )
-    # Generate the prompt based on user input
-    prompt = f"""{{
-        "weight": {weight},
-        "height": {height},
-        "age": {age},
-        "diseases": {diseases},
-        "allergies": {allergies},
-        "gender": "{gender}",
-        "exercise": "{exercise}",
-        "preferred": "{preferred_food}",
-        "food-type": "{food_type}"
-    }}"""
+    household_size = st.number_input("Household members", min_value=1, max_value=6, value=1,
+                                     help="Plan for the whole family in one request")
+    if household_size == 1:
+        st.subheader("Your Details")
+        profile = profile_form()
+    else:
+        profiles = []
+        for member, tab in enumerate(st.tabs([f"Member {i + 1}" for i in range(household_size)])):
+            with tab:
+                member_profile = profile_form(member)
+                member_profile["id"] = f"Member {member + 1}"
+                profiles.append(member_profile)
+        profile = profiles[0]
+    # Energy targets are computed locally and given to the model as fixed numbers
+    if household_size == 1:
+        targets = {"": nutrition.daily_targets(profile)}
+    else:
+        batch_targets = nutrition.daily_targets_batch(profiles)
+        targets = {
+            member_profile["id"]: {name: int(values[i]) for name, values in batch_targets.items()}
+            for i, member_profile in enumerate(profiles)
+        }
+    prompt = food_suggestions.build_prompt(profile, targets[""]["calories"] if household_size == 1 else None)
 
     #For Model1 and Model2
     
@@ -193,25 +473,106 @@ if functionality_choice == "Generate Meal Plan":
     # }}"""
 
     st.write("### Your Preferences and Details")
-    st.code(prompt)
+    if household_size == 1:
+        st.code(prompt)
+    else:
+        for member_profile in profiles:
+            st.code(food_suggestions.build_prompt(member_profile, targets[member_profile["id"]]["calories"]))
+    for member_id, target in targets.items():
+        st.write(
+            f"🎯 {member_id + ': ' if member_id else ''}Daily target {target['calories']} kcal "
+            f"(protein {target['protein_g']} g, fat {target['fat_g']} g, carbs {target['carbs_g']} g)"
+        )
 
-    # Button to generate and display the food suggestion
+    plan_format = st.radio(
+        "Plan format",
+        ["Full", "Compact (faster)", "Quick (ingredients and cooking steps load when you open a dish)"],
+        horizontal=True
+    )
+
+
+    # Starts generating in the background once the inputs have settled
+    speculation_key = (prompt, plan_format, model_choice)
+    if speculative and household_size == 1:
+        speculation.observe(st.session_state.session_id, speculation_key, generate_plan, plan_format, prompt)
+
+    # Button to generate the food suggestion. Generation runs as a background job so
+    # reruns don't lose it, and the plans are kept in the session once it finishes
+    session_id = st.session_state.session_id
     if st.button("Get Food Suggestion"):
-        with st.spinner("Generating food suggestion..."):
-            if model_choice == "SarrMal (Tuning)":
-                response = generate_food_suggestion_gemini(prompt)
-            else:
-                response = generate_food_suggestion_openai(prompt)
-            
-            if response:
-                display_meal_plan(response)
+        # Clicking again while a plan is being generated replaces that job. The deadline
+        # starts now, so time spent waiting for a worker counts against it too.
+        if household_size > 1:
+            cache_key = tuple(food_suggestions.build_prompt(p, targets[p["id"]]["calories"]) for p in profiles)
+            members = {p["id"]: (p, targets[p["id"]]["calories"]) for p in profiles}
+        else:
+            cache_key = prompt
+            members = {"": (profile, targets[""]["calories"])}
+        with request_context.use(deadline=time.monotonic() + PLAN_DEADLINE_SECONDS):
+            jobs.submit(
+                session_id, "meal_plan", meal_plan_job,
+                profiles if household_size > 1 else None, plan_format, prompt,
+                speculation_key if speculative else None, image_engine, cache_key, members, from_catalog
+            )
+        st.session_state.pending_targets = targets
+
+    finished = jobs.collect(session_id, "meal_plan")
+    if finished is not None:
+        if finished.status == "done":
+            st.session_state.meal_plans = finished.result["plans"]
+            st.session_state.lazy_images = finished.result["lazy_images"]
+            st.session_state.plan_notice = finished.result["notice"]
+            st.session_state.meal_targets = st.session_state.get("pending_targets", targets)
+        elif finished.status == "failed":
+            st.error(f"😥 {finished.error}")
+        else:
+            st.info("Meal plan generation was cancelled.")
+
+    job = jobs.get(session_id, "meal_plan")
+    if job is not None and job.active:
+        st.info(f"⏳ {job.stage} ({job.elapsed:.0f}s)")
+        if st.button("✖️ Cancel", disabled=job.cancel_event.is_set()):
+            jobs.cancel(session_id, "meal_plan")
+            st.rerun()
+
+    if st.session_state.get("plan_notice"):
+        st.info(st.session_state.plan_notice)
+    current_profiles = {"": profile} if household_size == 1 else {p["id"]: p for p in profiles}
+    for member_id, member_plan in st.session_state.get("meal_plans", {}).items():
+        if member_id:
+            st.header(member_id)
+        if member_plan:
+            target = st.session_state.get("meal_targets", {}).get(member_id)
+            calorie_problem = target and nutrition.check_plan(member_plan, target["calories"])
+            if calorie_problem:
+                st.warning(f"⚠️ Please double-check this plan: {calorie_problem}.")
+            # Swaps use the form as it is now, so a changed allergy is taken into account
+            member_profile = current_profiles.get(member_id)
+            if member_profile:
+                display_meal_plan(
+                    member_plan,
+                    key=member_id,
+                    prompt=food_suggestions.build_prompt(member_profile, targets[member_id]["calories"]),
+                    allergies=[a for a in member_profile["allergies"] if a != "None"]
+                )
             else:
-                st.warning("No response generated. Please check your input or try again later.")
+                display_meal_plan(member_plan, key=member_id)
+        elif member_id:
+            st.warning("No response generated for this member. Please try again later.")
+        else:
+            st.warning("No response generated. Please check your input or try again later.")
+
+    # Keep rerunning while the job works, the plan above stays on the page meanwhile
+    if job is not None and job.active:
+        time.sleep(JOB_POLL_SECONDS)
+        st.rerun()
 
 elif functionality_choice == "Chat about Food and Nutrition":
     st.write("Food oriented chat session!")
     if model_choice == "SarrMal (Tuning)":
         st.write("SarrMal (Tuning) is Active.")
+    elif model_choice == "Auto (fastest)":
+        st.write("Auto mode is Active: each message goes to the model answering fastest right now.")
     else:
         st.write("OpenAI (GPT-4) is Active.")
 
@@ -223,6 +584,8 @@ elif functionality_choice == "Chat about Food and Nutrition":
     # Initialize session state for chat history if not already initialized
     if 'chat_history' not in st.session_state:
         st.session_state.chat_history = []
+    if 'chat_context' not in st.session_state:
+        st.session_state.chat_context = chat_context.ChatContext()
 
     # Container for chat messages
     chat_container = st.container()
@@ -237,11 +600,11 @@ elif functionality_choice == "Chat about Food and Nutrition":
             st.session_state.chat_history.append({"role": "user", "message": user_input})
 
             # Generate response
-            with st.spinner("Generating response..."):
-                if model_choice == "SarrMal (Tuning)":
-                    response = chat_bots.gemini_chat_oauth(user_input)
-                else:
-                    response = chat_bots.openai_chat(user_input)
+            with st.spinner("Generating response..."), queued_request():
+                # Earlier turns, without the message that was just appended
+                history = st.session_state.chat_history[:-1]
+                # Opening questions asked before are answered from the FAQ cache
+                response = chat_bots.answer(user_input, provider_choice("chat"), history, st.session_state.chat_context)
 
             # Append AI response to chat history
             st.session_state.chat_history.append({"role": "assistant", "message": response})
@@ -260,6 +623,7 @@ elif functionality_choice == "Chat about Food and Nutrition":
     # Button to clear the chat history
     if st.button("Clear Chat"):
         st.session_state.chat_history = []
+        st.session_state.chat_context.reset()
         
 elif functionality_choice == "Search your own Food":
     st.write("Search for any food item!")
@@ -269,28 +633,85 @@ elif functionality_choice == "Search your own Food":
     # Option for user to upload an image or use the camera
     upload_option = st.radio("Choose image source:", ("Upload from device", "Use camera", "Use Text(If the image is not available)"))
     
+    food_name = None
     if upload_option == "Upload from device":
         uploaded_image = st.file_uploader("Upload an image of the food item", type=["jpg", "jpeg", "png"])
     elif upload_option == "Use camera":
         uploaded_image = st.camera_input("Take a picture of the food item")
     else:
         uploaded_image = None
-        food_name = st.text_input("Enter the name of the food item", "")
+        # A typed name skips detection and goes straight to the description and picture
+        typed_name = st.text_input("Enter the name of the food item", "").strip()
+        # Known dishes close to what was typed, so a misspelling doesn't cost a poor search
+        suggestions = dish_names.index.suggest(typed_name)
+        if suggestions and dish_names.normalize(suggestions[0]) != dish_names.normalize(typed_name):
+            as_typed = f'Search for "{typed_name}" as typed'
+            # Nothing is picked up front, so no search is spent on a guess
+            choice = st.selectbox("Did you mean", suggestions + [as_typed], index=None, placeholder="Pick the dish you meant")
+            if choice is None:
+                food_name = None
+            else:
+                food_name = typed_name if choice == as_typed else choice
+        else:
+            food_name = dish_names.index.canonical(typed_name) if typed_name else None
     
+    timings = {}
+    search_started = time.monotonic()
     if uploaded_image is not None:
         # Display the uploaded image
         st.image(uploaded_image, caption='Uploaded Image.', use_column_width=True)
         
-        # Encode and send the image to OpenAI API
-        base64_image = image_detection.encode_image(uploaded_image)
-        food_name = image_detection.get_food_name(base64_image)
+        # Downscale and send the image to OpenAI API (near-duplicate photos reuse the last answer)
+        try:
+            with queued_request(), food_search.timed("detection", timings):
+                food_name = image_detection.detect_food(uploaded_image)
+        except rate_limits.RateLimitExceeded as busy:
+            st.error(f"⏳ {busy}")
+            food_name = None
         
         # Display the result
         if food_name:
             st.write(f"The name of the food is: **{food_name}**")
         else:
             st.write("This is not recognized as a food item.")
-            
+
+    if food_name:
+        # Reruns of the page show the last search again instead of repeating it
+        search_key = (food_name.strip().lower(), image_engine)
+        last_search = st.session_state.get("food_search")
+        if last_search is not None and last_search["key"] == search_key:
+            display_food_search(last_search)
+        else:
+            result = {"key": search_key, "timings": timings}
+            placeholders = {"description": st.empty(), "picture": st.empty()}
+            placeholders["description"].info("👨‍🍳 Describing the dish...")
+            with_picture = not load_shedding.is_lite()
+            if with_picture:
+                placeholders["picture"].info("🖼️ Finding a picture...")
+            # Workers can't draw on the page, so they get the session without the queue display
+            with request_context.use(session_id=st.session_state.session_id):
+                futures = food_search.start(food_name, image_engine, timings, uploaded_image is not None, with_picture)
+            stages = {future: stage for stage, future in futures.items()}
+            # Each stage is shown as soon as it is ready, whichever finishes first
+            for future in as_completed(stages):
+                stage = stages[future]
+                try:
+                    result[stage] = future.result()
+                except rate_limits.RateLimitExceeded as busy:
+                    result[stage] = None
+                    placeholders[stage].error(f"⏳ {busy}")
+                    continue
+                except Exception as e:
+                    result[stage] = None
+                    placeholders[stage].error("😥 This part of the search failed. Please try again.")
+                    continue
+                with placeholders[stage].container():
+                    display_food_search(result, stage)
+            timings["total"] = time.monotonic() - search_started
+            food_search.record("total", timings["total"])
+            st.session_state.food_search = result
+            display_food_search(result, "timings")
+
 # elif functionality_choice == "Search your own Food":
 #     st.write("🍽️ **Search for any food item!**")
 #     st.write("🚀 Only SarrMal (Tuning) model is available for this functionality.")
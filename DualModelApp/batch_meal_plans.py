@@ -0,0 +1,143 @@
+"""
+Generates meal plans for a list of profiles without the Streamlit UI.
+
+Each input line is a JSON profile with the same fields as the "Your Details"
+form, plus an optional "id":
+
+    {"id": "clinic-001", "weight": 70, "height": 175, "age": 25, "gender": "Male",
+     "exercise": "Moderate", "diseases": ["None"], "allergies": ["Peanuts"],
+     "preferred": "Burmese", "food-type": "Balanced"}
+
+Usage:
+    python batch_meal_plans.py profiles.jsonl plans.jsonl --model sarrmal --concurrency 4
+
+Results are appended to the output file as they finish, so an interrupted run
+picks up where it stopped when started again with the same output file.
+"""
+import argparse
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dotenv import load_dotenv
+import openai
+import os
+from components import food_suggestions, request_context, nutrition, metering, router
+
+load_dotenv()
+openai.api_key = os.environ.get("OPEN_AI_API_KEY")
+
+GENERATORS = {
+    "sarrmal": food_suggestions.generate_gemini_v3,
+    "openai": food_suggestions.generate_openai,
+}
+
+
+def read_profiles(path):
+    profiles = []
+    with open(path, encoding="utf-8") as file:
+        for line_number, line in enumerate(file, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            profile = json.loads(line)
+            profile.setdefault("id", f"line-{line_number}")
+            profiles.append(profile)
+    return profiles
+
+
+def read_finished_ids(path, retry_errors):
+    # The output file doubles as the checkpoint
+    finished = set()
+    if not os.path.exists(path):
+        return finished
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # a line cut short by the interruption
+            if record.get("status") == "ok" or not retry_errors:
+                finished.add(record["id"])
+    return finished
+
+
+def run_profile(profile, target_calories, generate):
+    started = time.monotonic()
+    try:
+        with request_context.use(session_id="batch", feature="batch_meal_plan"):
+            plan = generate(food_suggestions.build_prompt(profile, target_calories))
+        error = None if plan else "no plan generated"
+    except Exception as e:
+        plan, error = None, str(e)
+    return {
+        "id": profile["id"],
+        "status": "ok" if plan else "error",
+        "profile": {k: v for k, v in profile.items() if k != "id"},
+        "latency": round(time.monotonic() - started, 3),
+        "target_calories": target_calories,
+        "calorie_check": nutrition.check_plan(plan, target_calories) if plan else None,
+        "plan": plan,
+        "error": error,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate meal plans for profiles in a JSONL file.")
+    parser.add_argument("profiles", help="Input JSONL file, one profile per line")
+    parser.add_argument("output", help="Output JSONL file, also used to resume")
+    parser.add_argument("--model", choices=sorted(GENERATORS), default="sarrmal")
+    parser.add_argument("--concurrency", type=int, default=4, help="Profiles generated at once")
+    parser.add_argument("--retry-errors", action="store_true", help="Regenerate profiles that failed last run")
+    args = parser.parse_args(argv)
+
+    profiles = read_profiles(args.profiles)
+    finished = read_finished_ids(args.output, args.retry_errors)
+    pending = [p for p in profiles if p["id"] not in finished]
+    print(f"{len(profiles)} profiles, {len(profiles) - len(pending)} already done, {len(pending)} to go", file=sys.stderr)
+
+    generate = GENERATORS[args.model]
+    # The per-session budgets are for the web app, a batch run is one big session
+    metering.configure(session_daily_budget=None, daily_budget=None)
+    latencies = []
+    errors = 0
+    flagged = 0
+    started = time.monotonic()
+
+    with open(args.output, "a", encoding="utf-8") as output, \
+            ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        if output.tell() > 0:
+            output.write("\n")  # keep a line cut short by an interruption on its own line
+        # Targets for the whole run are computed in one vectorised pass
+        targets = nutrition.daily_targets_batch(pending)["calories"] if pending else []
+        futures = [
+            pool.submit(run_profile, profile, int(target), generate)
+            for profile, target in zip(pending, targets)
+        ]
+        for done, future in enumerate(as_completed(futures), start=1):
+            record = future.result()
+            latencies.append(record["latency"])
+            errors += record["status"] != "ok"
+            flagged += record["calorie_check"] is not None
+            output.write(json.dumps(record, ensure_ascii=False) + "\n")
+            output.flush()
+            print(f"[{done}/{len(pending)}] {record['id']}: {record['status']} in {record['latency']:.1f}s", file=sys.stderr)
+
+    elapsed = time.monotonic() - started
+    if pending:
+        print(
+            f"Done: {len(pending)} profiles in {elapsed:.1f}s "
+            f"({len(pending) / elapsed * 60:.1f}/min), "
+            f"error rate {errors / len(pending):.1%}, "
+            f"p50 {router.percentile(latencies, 0.5):.1f}s, p95 {router.percentile(latencies, 0.95):.1f}s, "
+            f"{flagged} plans off their calorie target, "
+            f"estimated cost ${metering.get_stats()['cost_usd']:.2f}",
+            file=sys.stderr,
+        )
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,197 @@
+"""
+Labels a directory of food photos (e.g. a restaurant menu photo dump) with
+dish names, without the Streamlit UI.
+
+Every image under the directory is downscaled the same way as an upload and
+sent to the vision model. Identical files, found by content hash, are only
+sent once.
+
+Usage:
+    python batch_photo_labels.py photos/ labels.jsonl --csv labels.csv --concurrency 4 --rpm 200
+
+Results are appended to the output file as they finish, so an interrupted run
+picks up where it stopped when started again with the same output file.
+"""
+import argparse
+import csv
+import hashlib
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dotenv import load_dotenv
+import openai
+import os
+from components import image_detection, rate_limits, request_context, metering, router
+
+load_dotenv()
+openai.api_key = os.environ.get("OPEN_AI_API_KEY")
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp"}
+# Tries per image while the vision model is busy, and the wait before the first retry
+MAX_ATTEMPTS = 3
+RETRY_SECONDS = 5.0
+
+
+def find_images(directory):
+    paths = []
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                paths.append(os.path.relpath(os.path.join(root, name), directory))
+    return sorted(paths)
+
+
+def content_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_finished(path, retry_errors):
+    # The output file doubles as the checkpoint: finished paths, and names already known per hash
+    finished, names = set(), {}
+    if not os.path.exists(path):
+        return finished, names
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # a line cut short by the interruption
+            if record.get("status") == "ok":
+                names[record["sha256"]] = record["food_name"]
+            if record.get("status") == "ok" or not retry_errors:
+                finished.add(record["path"])
+    return finished, names
+
+
+def label_image(path):
+    started = time.monotonic()
+    food_name, error = None, None
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            with request_context.use(session_id="batch", feature="batch_photo_label"):
+                food_name = image_detection.get_food_name(image_detection.encode_image(path))
+            error = None if food_name else "no name returned"
+            break
+        except rate_limits.RateLimitExceeded as busy:
+            # Includes an open circuit breaker: wait for the model to recover
+            error = str(busy)
+            time.sleep(RETRY_SECONDS * 2 ** attempt)
+        except Exception as e:
+            error = str(e)
+            break
+    return food_name, error, round(time.monotonic() - started, 3)
+
+
+def write_csv(jsonl_path, csv_path):
+    # Latest record per path, so retried images appear once
+    records = {}
+    with open(jsonl_path, encoding="utf-8") as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            records[record["path"]] = record
+    with open(csv_path, "w", newline="", encoding="utf-8") as file:
+        writer = csv.writer(file)
+        writer.writerow(["path", "sha256", "food_name", "status", "duplicate_of", "error"])
+        for path in sorted(records):
+            r = records[path]
+            writer.writerow([path, r["sha256"], r["food_name"] or "", r["status"], r["duplicate_of"] or "", r["error"] or ""])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Label a directory of food photos with dish names.")
+    parser.add_argument("directory", help="Directory of images, searched recursively")
+    parser.add_argument("output", help="Output JSONL file, also used to resume")
+    parser.add_argument("--csv", help="Also write the labels to this CSV file at the end")
+    parser.add_argument("--concurrency", type=int, default=4, help="Images classified at once")
+    parser.add_argument("--rpm", type=int, help="Vision model requests per minute (default: the app's limit)")
+    parser.add_argument("--retry-errors", action="store_true", help="Classify images that failed last run again")
+    args = parser.parse_args(argv)
+
+    if args.rpm:
+        limits = rate_limits.DEFAULT_LIMITS[("openai", "gpt-4o")]
+        rate_limits.configure("openai", "gpt-4o", rpm=args.rpm, tpm=limits["tpm"])
+    # The per-session budgets are for the web app, a batch run is one big session
+    metering.configure(session_daily_budget=None, daily_budget=None)
+
+    paths = find_images(args.directory)
+    finished, names = read_finished(args.output, args.retry_errors)
+    pending = [p for p in paths if p not in finished]
+    print(f"{len(paths)} images, {len(paths) - len(pending)} already done, {len(pending)} to go", file=sys.stderr)
+
+    # Identical files are classified once, through the first path seen
+    by_hash = {}
+    for path in pending:
+        by_hash.setdefault(content_hash(os.path.join(args.directory, path)), []).append(path)
+
+    latencies = []
+    errors = 0
+    calls = 0
+    done = 0
+    started = time.monotonic()
+
+    def write(output, path, sha256, food_name, error, latency, duplicate_of):
+        nonlocal done, errors
+        record = {
+            "path": path,
+            "sha256": sha256,
+            "status": "ok" if food_name else "error",
+            "food_name": food_name,
+            "latency": latency,
+            "duplicate_of": duplicate_of,
+            "error": error,
+        }
+        done += 1
+        errors += record["status"] != "ok"
+        output.write(json.dumps(record, ensure_ascii=False) + "\n")
+        output.flush()
+        print(f"[{done}/{len(pending)}] {path}: {food_name or error}", file=sys.stderr)
+
+    with open(args.output, "a", encoding="utf-8") as output, \
+            ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        if output.tell() > 0:
+            output.write("\n")  # keep a line cut short by an interruption on its own line
+        futures = {}
+        for sha256, group in by_hash.items():
+            if sha256 in names:  # labelled in an earlier run under another path
+                for path in group:
+                    write(output, path, sha256, names[sha256], None, 0.0, "earlier run")
+                continue
+            futures[pool.submit(label_image, os.path.join(args.directory, group[0]))] = (sha256, group)
+        for future in as_completed(futures):
+            sha256, group = futures[future]
+            food_name, error, latency = future.result()
+            calls += 1
+            latencies.append(latency)
+            for number, path in enumerate(group):
+                write(output, path, sha256, food_name, error, latency if number == 0 else 0.0,
+                      group[0] if number else None)
+
+    if args.csv:
+        write_csv(args.output, args.csv)
+
+    elapsed = time.monotonic() - started
+    if pending:
+        print(
+            f"Done: {len(pending)} images in {elapsed:.1f}s "
+            f"({len(pending) / elapsed * 60:.1f} images/min), "
+            f"{calls} sent to the model, {len(pending) - calls} reused for identical files, "
+            f"error rate {errors / len(pending):.1%}, "
+            f"p50 {router.percentile(latencies, 0.5):.1f}s, p95 {router.percentile(latencies, 0.95):.1f}s, "
+            f"estimated cost ${metering.get_stats()['cost_usd']:.2f}",
+            file=sys.stderr,
+        )
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,27 +1,54 @@
 import streamlit as st
+import google.ai.generativelanguage as glm
 import google.generativeai as genai
+import google.api_core.exceptions
 import os
 from dotenv import load_dotenv
 import openai
 import json
+from components import chat_context, rate_limits, scheduler, circuit_breaker, load_shedding, metering, credentials, faq_cache
 
 load_dotenv()
 
+# gemini-pro is called with the API key through a client of its own, built once
+# per process. genai.configure is process-wide and would undo the OAuth setup
+# the tuned models use (see credentials.py).
+_api_key_client = None
+
+def _api_key_model(model_name, **kwargs):
+    global _api_key_client
+    if _api_key_client is None:
+        _api_key_client = glm.GenerativeServiceClient(client_options={"api_key": os.environ.get("GEMINI_AI_API_KEY")})
+    model = genai.GenerativeModel(model_name, **kwargs)
+    model._client = _api_key_client
+    return model
+
 # Function to generate a response using Google Generative AI
 def gemini_chat_api(prompt):
-    # Configuration
-    genai.configure(api_key=os.environ.get("GEMINI_AI_API_KEY"))
     generation_config = {"temperature": 0.25, "max_output_tokens": 1024, "top_k": 40, "top_p": 0.95}
         
     try:
-        model = genai.GenerativeModel("gemini-pro", generation_config=generation_config)
-        chat_session = genai.ChatSession(model=model)  # Initialize chat session
-        gemini_response = chat_session.send_message(prompt)
+        with metering.meter("gemini", "gemini-pro", "chat", prompt) as usage, \
+                circuit_breaker.guard("gemini", "gemini-pro"), scheduler.admit("gemini", "chat"):
+            rate_limits.acquire("gemini", "gemini-pro", rate_limits.estimate_tokens(prompt, 1024))
+            usage.sending()
+            model = _api_key_model("gemini-pro", generation_config=generation_config)
+            chat_session = genai.ChatSession(model=model)  # Initialize chat session
+            gemini_response = chat_session.send_message(prompt)
+            usage.set_response(gemini_response)
 
         # Access text using the correct attribute
         generated_text = gemini_response.candidates[0].content.parts[0].text  
         return generated_text
-    except genai.exceptions.APIError as api_err:
+    except circuit_breaker.CircuitOpen as down:
+        if circuit_breaker.available("openai", "gpt-3.5-turbo"):
+            return openai_chat(prompt)
+        st.error(f"⏳ {down}")
+        return None
+    except rate_limits.RateLimitExceeded as busy:
+        st.error(f"⏳ {busy}")
+        return None
+    except google.api_core.exceptions.GoogleAPIError as api_err:
         # Specific handling for API errors
         st.error("😔 Oops! There was a problem connecting to the AI service. Please try again later.")
         # Log the error if needed for debugging (not shown to the user)
@@ -38,15 +65,36 @@ def gemini_chat_api(prompt):
         st.write(e)
         return None
 
-def gemini_chat_oauth(prompt):
+def gemini_chat_oauth(prompt, history=None, context=None, max_tokens=None):
     try:
-        model = genai.GenerativeModel(model_name='tunedModels/food-chatbot-v2-471btbzagxuv')
-        result = model.generate_content(prompt)
+        model_name = 'tunedModels/food-chatbot-v2-471btbzagxuv'
+        model = credentials.manager.model(model_name)  # shared OAuth token, refreshed in the background
+        if history and context is not None:
+            # Earlier turns go in as a rolling summary plus the last few messages
+            contents = chat_context.gemini_contents(context, history, prompt)
+        else:
+            contents = prompt
+        generation_config = {"max_output_tokens": max_tokens} if max_tokens else None
+        with metering.meter("gemini", model_name, "chat", str(contents)) as usage, \
+                circuit_breaker.guard("gemini", model_name), scheduler.admit("gemini", "chat"):
+            rate_limits.acquire("gemini", model_name, rate_limits.estimate_tokens(str(contents), max_tokens or 1024))
+            usage.sending()
+            result = model.generate_content(contents, generation_config=generation_config)
+            usage.set_response(result)
         return result.text
     except json.JSONDecodeError as json_err:
         st.error("😥 There was an error processing the response. Please try again later.")
         st.write(json_err)
         return None
+    except circuit_breaker.CircuitOpen as down:
+        # The tuned chatbot is failing, OpenAI answers with the same context
+        if circuit_breaker.available("openai", "gpt-3.5-turbo"):
+            return openai_chat(prompt, history, context, max_tokens)
+        st.error(f"⏳ {down}")
+        return None
+    except rate_limits.RateLimitExceeded as busy:
+        st.error(f"⏳ {busy}")
+        return None
     except Exception as e:
         st.error("😥 An unexpected error occurred. Please try again.")
         st.write(e)
@@ -56,13 +104,66 @@ def gemini_chat_oauth(prompt):
 openai.api_key = os.environ.get("OPEN_AI_API_KEY") 
 
 # Function to generate a response from OpenAI
-def openai_chat(prompt):
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[
+def openai_chat(prompt, history=None, context=None, max_tokens=None):
+    if history and context is not None:
+        messages = chat_context.openai_messages(
+            context, history, prompt, system_prompt="You are a helpful assistant."
+        )
+    else:
+        messages = [
             {"role": "system", "content": "You are a helpful assistant."},
             {"role": "user", "content": prompt}
         ]
-    )
+    limit = {"max_tokens": max_tokens} if max_tokens else {}
+    try:
+        with metering.meter("openai", "gpt-3.5-turbo", "chat", str(messages)) as usage, \
+                circuit_breaker.guard("openai", "gpt-3.5-turbo"), scheduler.admit("openai", "chat"):
+            rate_limits.acquire("openai", "gpt-3.5-turbo", rate_limits.estimate_tokens(str(messages), max_tokens or 1024))
+            usage.sending()
+            response = openai.ChatCompletion.create(
+                model="gpt-3.5-turbo",
+                messages=messages,
+                **limit
+            )
+            usage.set_response(response)
+    except circuit_breaker.CircuitOpen as down:
+        # OpenAI is failing, the tuned chatbot answers with the same context
+        if circuit_breaker.available("gemini", "tunedModels/food-chatbot-v2-471btbzagxuv"):
+            return gemini_chat_oauth(prompt, history, context, max_tokens)
+        st.error(f"⏳ {down}")
+        return None
+    except rate_limits.RateLimitExceeded as busy:
+        st.error(f"⏳ {busy}")
+        return None
     message = response.choices[0].message["content"].strip()
-    return message
\ No newline at end of file
+    return message
+
+
+def answer(prompt, provider, history=None, context=None):
+    """
+    Answers a chat message with the chosen backend. Opening questions are
+    answered from the FAQ cache when a near-identical one was answered before.
+
+    Parameters:
+    - prompt (str): The user's message.
+    - provider (str): "sarrmal" for the tuned chatbot or "openai".
+    - history (list): Earlier turns, without this message.
+    - context (ChatContext): The session's rolling summary.
+
+    Returns:
+    - str: The reply, or None if it couldn't be generated.
+    """
+    first_turn = not history
+    if first_turn:
+        cached = faq_cache.lookup(prompt, provider)
+        if cached is not None:
+            return cached
+    # Replies are kept short while the service is overloaded or the user is near their budget
+    max_tokens = load_shedding.chat_max_tokens() or metering.chat_max_tokens()
+    if provider == "sarrmal":
+        reply = gemini_chat_oauth(prompt, history, context, max_tokens)
+    else:
+        reply = openai_chat(prompt, history, context, max_tokens)
+    if first_turn and reply and max_tokens is None:
+        faq_cache.store(prompt, reply, provider)  # shortened replies aren't worth reusing
+    return reply
@@ -0,0 +1,133 @@
+import re
+from components import rate_limits
+
+SYSTEM_PROMPT = "You are a helpful assistant for food, cooking and nutrition questions."
+
+_SENTENCE_RE = re.compile(r"(?<=[.!?])\s+")
+
+
+def summarize_turns(summary, turns, max_words=30):
+    """
+    Cheap local summarizer: keeps the first sentence of each turn, clipped to a
+    few words, so folding new turns in costs the same however long the chat is.
+
+    Parameters:
+    - summary (str): The summary of all earlier turns.
+    - turns (list): New {"role", "message"} turns to fold in.
+
+    Returns:
+    - str: The updated summary.
+    """
+    lines = [summary] if summary else []
+    for turn in turns:
+        text = (turn.get("message") or "").strip()
+        if not text:
+            continue
+        first = _SENTENCE_RE.split(text, maxsplit=1)[0]
+        words = first.split()
+        if len(words) > max_words:
+            first = " ".join(words[:max_words]) + "..."
+        speaker = "User asked" if turn["role"] == "user" else "Assistant said"
+        lines.append(f"- {speaker}: {first}")
+    return "\n".join(lines)
+
+
+class ChatContext:
+    """
+    Builds each chat request from a token budget: the system prompt, a rolling
+    summary of older turns and the last few turns verbatim.
+
+    The summary is updated incrementally and kept on the object (store it in
+    st.session_state), so only turns that just fell out of the verbatim window
+    are summarized on each request.
+    """
+
+    def __init__(self, token_budget=1500, keep_last=6, summary_tokens=400, summarize=summarize_turns):
+        self.token_budget = token_budget
+        self.keep_last = keep_last
+        self.summary_tokens = summary_tokens
+        self.summarize = summarize
+        self.summary = ""
+        self.summarized_upto = 0  # number of history messages already folded into the summary
+
+    def reset(self):
+        self.summary = ""
+        self.summarized_upto = 0
+
+    def _fold(self, history, upto):
+        if upto > self.summarized_upto:
+            self.summary = self.summarize(self.summary, history[self.summarized_upto:upto])
+            self.summarized_upto = upto
+        # Drop the oldest summary lines once the summary outgrows its share
+        limit = min(self.summary_tokens, self.token_budget // 3)
+        lines = self.summary.split("\n")
+        while len(lines) > 1 and rate_limits.estimate_tokens("\n".join(lines)) > limit:
+            lines.pop(0)
+        self.summary = "\n".join(lines)
+
+    def build(self, history, prompt, system_prompt=SYSTEM_PROMPT):
+        """
+        Parameters:
+        - history (list): Earlier {"role", "message"} turns, not including the prompt.
+        - prompt (str): The new user message.
+        - system_prompt (str): Instructions placed ahead of everything else.
+
+        Returns:
+        - tuple: (system_prompt, summary, turns) where turns are the verbatim
+          recent turns that fit in the budget.
+        """
+        history = [turn for turn in history if turn.get("message")]
+        if len(history) < self.summarized_upto:
+            # The chat was cleared or replaced, start over
+            self.reset()
+
+        start = max(self.summarized_upto, len(history) - self.keep_last)
+        self._fold(history, start)
+
+        fixed = rate_limits.estimate_tokens(system_prompt) + rate_limits.estimate_tokens(prompt)
+        while start < len(history):
+            used = fixed + rate_limits.estimate_tokens(self.summary)
+            used += sum(rate_limits.estimate_tokens(turn["message"]) for turn in history[start:])
+            if used <= self.token_budget:
+                break
+            start += 1
+            self._fold(history, start)
+        return system_prompt, self.summary, history[start:]
+
+
+def _preamble(system_prompt, summary):
+    if summary:
+        return f"{system_prompt}\n\nSummary of the earlier conversation:\n{summary}"
+    return system_prompt
+
+
+def openai_messages(context, history, prompt, system_prompt=SYSTEM_PROMPT):
+    """
+    Returns the OpenAI chat messages for a prompt and its history.
+    """
+    system_prompt, summary, turns = context.build(history, prompt, system_prompt)
+    messages = [{"role": "system", "content": _preamble(system_prompt, summary)}]
+    for turn in turns:
+        messages.append({"role": turn["role"], "content": turn["message"]})
+    messages.append({"role": "user", "content": prompt})
+    return messages
+
+
+def gemini_contents(context, history, prompt, system_prompt=SYSTEM_PROMPT):
+    """
+    Returns Gemini `contents` for a prompt and its history. Tuned models take no
+    system instruction and need alternating roles starting with the user, so
+    the preamble is put in front of the first user turn.
+    """
+    system_prompt, summary, turns = context.build(history, prompt, system_prompt)
+    contents = []
+    for turn in turns + [{"role": "user", "message": prompt}]:
+        role = "user" if turn["role"] == "user" else "model"
+        if not contents and role != "user":
+            continue
+        if contents and contents[-1]["role"] == role:
+            contents[-1]["parts"][0] += "\n\n" + turn["message"]
+        else:
+            contents.append({"role": role, "parts": [turn["message"]]})
+    contents[0]["parts"][0] = _preamble(system_prompt, summary) + "\n\n" + contents[0]["parts"][0]
+    return contents
@@ -0,0 +1,181 @@
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from components import rate_limits, request_context, router
+
+logger = logging.getLogger(__name__)
+
+# A breaker opens after this many failed calls in a row (errors and timeouts),
+# fails fast while open, and lets one trial call through after OPEN_SECONDS.
+FAILURE_THRESHOLD = 5
+OPEN_SECONDS = 30.0
+
+# Where a meal plan goes when its model's breaker is open. The older tuned
+# version takes the same profile prompt as v3.
+FALLBACK_MODELS = {
+    ("gemini", "tunedModels/food-suggestion-ai-v3-t2z0eh7qpaq8"): ("gemini", "tunedModels/food-suggestion-ai-v1-uss801z982xp"),
+}
+
+# State changes kept for the metrics panel
+RECENT_EVENTS = 20
+
+
+class CircuitOpen(rate_limits.RateLimitExceeded):
+    """Raised without calling the provider while its breaker is open."""
+
+
+class _Breaker:
+    def __init__(self):
+        self.state = "closed"  # closed, open or half_open
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.calls = 0
+        self.failed_calls = 0
+        self.rejected = 0
+
+
+_lock = threading.Lock()
+_breakers = {}
+_events = deque(maxlen=RECENT_EVENTS)
+
+
+def _breaker(provider, model):
+    breaker = _breakers.get((provider, model))
+    if breaker is None:
+        breaker = _breakers[(provider, model)] = _Breaker()
+    return breaker
+
+
+def _set_state(provider, model, breaker, state):
+    # Runs with _lock held
+    logger.warning("Circuit breaker for %s %s: %s -> %s", provider, model, breaker.state, state)
+    _events.append({"time": time.strftime("%H:%M:%S"), "provider": provider, "model": model,
+                    "from": breaker.state, "to": state})
+    breaker.state = state
+
+
+def _allow(provider, model, breaker, now):
+    # Runs with _lock held. Returns True if a call may go ahead.
+    if breaker.state == "open" and now - breaker.opened_at >= OPEN_SECONDS:
+        _set_state(provider, model, breaker, "half_open")
+    if breaker.state == "closed":
+        return True
+    if breaker.state == "half_open" and not breaker.trial_running:
+        breaker.trial_running = True
+        return True
+    return False
+
+
+def available(provider, model):
+    """
+    Returns True if a call to this provider/model would go ahead, without
+    taking the half-open trial slot. Used to pick a fallback.
+    """
+    with _lock:
+        breaker = _breaker(provider, model)
+        if breaker.state == "open":
+            return time.monotonic() - breaker.opened_at >= OPEN_SECONDS
+        return not (breaker.state == "half_open" and breaker.trial_running)
+
+
+def route(provider, model):
+    """
+    Returns the (provider, model) to call: the one asked for, or the first
+    configured fallback whose breaker isn't open.
+
+    Raises:
+    - CircuitOpen: If every option is open.
+    """
+    option = (provider, model)
+    while option is not None:
+        if available(*option):
+            return option
+        option = FALLBACK_MODELS.get(option)
+    raise CircuitOpen(f"The {provider} service is having trouble right now. Please try again in a minute.")
+
+
+def can_route(provider, model):
+    """
+    Returns True if `route` would find a provider/model to call.
+    """
+    try:
+        route(provider, model)
+        return True
+    except CircuitOpen:
+        return False
+
+
+@contextmanager
+def guard(provider, model):
+    """
+    Runs a provider call through the breaker for this provider/model. Errors
+    raised inside the block count as failures, except our own queueing,
+    rate-limit and cancellation errors, which say nothing about the provider.
+    Calls that reach the provider are also timed for the router.
+
+    Raises:
+    - CircuitOpen: Straight away, if the breaker is open.
+    """
+    with _lock:
+        breaker = _breaker(provider, model)
+        if not _allow(provider, model, breaker, time.monotonic()):
+            breaker.rejected += 1
+            raise CircuitOpen(f"The {provider} service is having trouble right now. Please try again in a minute.")
+        trial = breaker.state == "half_open"
+    started = time.monotonic()
+    try:
+        yield
+    except (rate_limits.RateLimitExceeded, request_context.Cancelled):
+        with _lock:
+            if trial:
+                breaker.trial_running = False
+        raise
+    except Exception:
+        router.record(provider, model, time.monotonic() - started, ok=False)
+        with _lock:
+            breaker.calls += 1
+            breaker.failed_calls += 1
+            breaker.failures += 1
+            if trial:
+                breaker.trial_running = False
+            if trial or (breaker.state == "closed" and breaker.failures >= FAILURE_THRESHOLD):
+                breaker.opened_at = time.monotonic()
+                _set_state(provider, model, breaker, "open")
+        raise
+    except BaseException:
+        # Interrupted, e.g. by a Streamlit rerun from the queue display: no verdict on
+        # the provider, but the trial slot is given back so the breaker can try again
+        with _lock:
+            if trial:
+                breaker.trial_running = False
+        raise
+    router.record(provider, model, time.monotonic() - started, ok=True)
+    with _lock:
+        breaker.calls += 1
+        breaker.failures = 0
+        if trial:
+            breaker.trial_running = False
+            _set_state(provider, model, breaker, "closed")
+
+
+def get_stats():
+    """
+    Returns the state and call counts of every breaker, and the recent state changes.
+    """
+    with _lock:
+        return {
+            "breakers": {
+                f"{provider} {model}": {
+                    "state": breaker.state,
+                    "consecutive_failures": breaker.failures,
+                    "calls": breaker.calls,
+                    "failed_calls": breaker.failed_calls,
+                    "rejected": breaker.rejected,
+                }
+                for (provider, model), breaker in _breakers.items()
+            },
+            "recent_changes": list(_events),
+        }
@@ -0,0 +1,78 @@
+import json
+from components import rate_limits
+
+# Meals and dishes are positional in the compact format, in this order
+MEAL_TIMES = ("breakfast", "lunch", "dinner")
+DISH_SLOTS = ("main_dish", "side_dish")
+DISH_FIELDS = ("name", "calories", "category", "ingredients", "how_to_cook")
+
+# The compact format has no meal_time strings, these are filled back in
+DEFAULT_MEAL_TIMES = {"breakfast": "07:00 AM", "lunch": "12:00 PM", "dinner": "07:00 PM"}
+
+COMPACT_INSTRUCTIONS = """Respond ONLY with compact JSON, no spaces or line breaks needed:
+{"p":[[M,S],[M,S],[M,S]]}
+The three pairs are breakfast, lunch and dinner in that order. M is the main dish and S the side dish, each written as
+["name",calories,"category",["ingredient",...],"how to cook"]"""
+
+
+def compress(plan):
+    """
+    Converts a full meal plan ({"response": {meal: {slot: dish}}}) into the
+    compact wire format. Used for the few-shot example and for measuring.
+    """
+    meals = []
+    for meal_time in MEAL_TIMES:
+        meal = plan["response"].get(meal_time, {})
+        meals.append([
+            [meal.get(slot, {}).get(field) for field in DISH_FIELDS]
+            for slot in DISH_SLOTS
+        ])
+    return {"p": meals}
+
+
+def expand(data):
+    """
+    Expands the compact wire format into the response -> breakfast/lunch/dinner
+    -> main_dish/side_dish structure that display_meal_plan uses. Data already
+    in the full structure is returned unchanged.
+
+    Parameters:
+    - data (dict): {"p": [[main, side], ...]} as returned by the model.
+
+    Returns:
+    - dict: The full meal plan.
+
+    Raises:
+    - ValueError: If the data is in neither format.
+    """
+    if isinstance(data, dict) and "response" in data:
+        return data
+    if not isinstance(data, dict) or not isinstance(data.get("p"), list):
+        raise ValueError("Model output is not in the compact meal plan format")
+
+    response = {}
+    for meal_time, pair in zip(MEAL_TIMES, data["p"]):
+        meal = {}
+        for slot, values in zip(DISH_SLOTS, pair or []):
+            if not isinstance(values, list):
+                continue
+            dish = {field: value for field, value in zip(DISH_FIELDS, values)}
+            dish.setdefault("ingredients", [])
+            dish["meal_time"] = DEFAULT_MEAL_TIMES[meal_time]
+            meal[slot] = dish
+        response[meal_time] = meal
+    return {"response": response}
+
+
+def measure(plan):
+    """
+    Returns the estimated output tokens of a plan in the full and compact
+    formats, and the share saved by the compact one.
+    """
+    full_tokens = rate_limits.estimate_tokens(json.dumps(plan, ensure_ascii=False))
+    compact_tokens = rate_limits.estimate_tokens(json.dumps(compress(plan), ensure_ascii=False, separators=(",", ":")))
+    return {
+        "full_tokens": full_tokens,
+        "compact_tokens": compact_tokens,
+        "saving": 1 - compact_tokens / full_tokens if full_tokens else 0.0,
+    }
@@ -0,0 +1,152 @@
+import datetime
+import logging
+import threading
+import time
+import google.auth
+import google.auth.exceptions
+import google.auth.transport.requests
+import google.ai.generativelanguage as glm
+import google.generativeai as genai
+
+logger = logging.getLogger(__name__)
+
+# The scopes the tuned models were authorised with (see Notebooks/notes.ipynb)
+SCOPES = [
+    "https://www.googleapis.com/auth/cloud-platform",
+    "https://www.googleapis.com/auth/generative-language.tuning",
+]
+
+# Tokens are refreshed this long before they expire. It is above google-auth's
+# own 3m45s threshold, so requests never find a stale token and refresh inline.
+REFRESH_MARGIN_SECONDS = 600.0
+# Wait before trying again after a failed background refresh
+RETRY_SECONDS = 30.0
+
+
+class CredentialManager:
+    """
+    Application-default OAuth credentials for the tuned Gemini models, loaded
+    once per process and shared by every thread. A background thread refreshes
+    the access token before it expires, so user requests don't pay for the
+    auth round trip.
+
+    The credentials go to a client of the manager's own rather than to
+    genai.configure, which is process-wide: the API-key chat would otherwise
+    wipe them, and they would wipe its key.
+    """
+
+    def __init__(self, scopes=SCOPES, refresh_margin=REFRESH_MARGIN_SECONDS):
+        self.scopes = scopes
+        self.refresh_margin = refresh_margin
+        self._credentials = None
+        self._client = None
+        self._lock = threading.Lock()          # guards the stats
+        self._refresh_lock = threading.Lock()  # one load or refresh at a time
+        self._unavailable = False
+        self._stats = {"loads": 0, "load_seconds": 0.0, "background_refreshes": 0, "inline_refreshes": 0,
+                       "refresh_seconds": 0.0, "last_refresh_seconds": None, "errors": 0}
+
+    def _record(self, kind, seconds):
+        with self._lock:
+            self._stats[kind] += 1
+            if kind == "loads":
+                self._stats["load_seconds"] += seconds
+            else:
+                self._stats["refresh_seconds"] += seconds
+                self._stats["last_refresh_seconds"] = round(seconds, 3)
+
+    def _refresh(self, kind):
+        # Runs with _refresh_lock held
+        started = time.monotonic()
+        self._credentials.refresh(google.auth.transport.requests.Request())
+        self._record(kind, time.monotonic() - started)
+
+    def _seconds_left(self):
+        expiry = self._credentials.expiry
+        if expiry is None:
+            return None  # a token that doesn't expire
+        return (expiry - datetime.datetime.utcnow()).total_seconds()
+
+    def ensure(self):
+        """
+        Loads the credentials on first use and builds their client. Later calls
+        return straight away unless the background refresh has fallen behind,
+        in which case the token is refreshed inline.
+
+        Returns:
+        - google.auth.credentials.Credentials: The shared credentials, or None if
+          no application-default credentials are set up (genai then keeps its
+          own configuration, e.g. an API key).
+        """
+        credentials = self._credentials
+        if credentials is not None and credentials.valid:
+            return credentials
+        with self._refresh_lock:
+            if self._unavailable:
+                return None
+            try:
+                if self._credentials is None:
+                    started = time.monotonic()
+                    self._credentials, _ = google.auth.default(scopes=self.scopes)
+                    self._record("loads", time.monotonic() - started)
+                    self._refresh("inline_refreshes")
+                    self._client = glm.GenerativeServiceClient(credentials=self._credentials)
+                    threading.Thread(target=self._refresh_loop, name="credential-refresh", daemon=True).start()
+                elif not self._credentials.valid:
+                    self._refresh("inline_refreshes")
+            except google.auth.exceptions.DefaultCredentialsError:
+                logger.warning("No application-default credentials found, tuned models use the genai defaults")
+                self._unavailable = True
+                return None
+            except google.auth.exceptions.GoogleAuthError:
+                with self._lock:
+                    self._stats["errors"] += 1
+                raise
+            return self._credentials
+
+    def model(self, model_name, **kwargs):
+        """
+        Returns a genai.GenerativeModel that calls a tuned model with the
+        shared credentials, or with the genai defaults if there are none.
+        """
+        self.ensure()
+        model = genai.GenerativeModel(model_name=model_name, **kwargs)
+        if self._client is not None:
+            model._client = self._client  # genai has no public way to give one model its own client
+        return model
+
+    def _refresh_loop(self):
+        while True:
+            left = self._seconds_left()
+            if left is None:
+                return
+            time.sleep(max(left - self.refresh_margin, 0.0))
+            try:
+                with self._refresh_lock:
+                    if self._seconds_left() <= self.refresh_margin:
+                        self._refresh("background_refreshes")
+            except Exception as e:
+                logger.warning("Background credential refresh failed: %s", e)
+                with self._lock:
+                    self._stats["errors"] += 1
+                time.sleep(RETRY_SECONDS)
+
+    def stats(self):
+        """
+        Returns load and refresh counts and auth latency, kept apart from the
+        model latency the router and metering see.
+        """
+        with self._lock:
+            refreshes = self._stats["background_refreshes"] + self._stats["inline_refreshes"]
+            return {
+                **self._stats,
+                "load_seconds": round(self._stats["load_seconds"], 3),
+                "refresh_seconds": round(self._stats["refresh_seconds"], 3),
+                "mean_refresh_seconds": round(self._stats["refresh_seconds"] / refreshes, 3) if refreshes else None,
+                "expires_in_seconds": round(self._seconds_left()) if self._credentials and self._credentials.expiry else None,
+                "available": not self._unavailable,
+            }
+
+
+# One set of credentials shared by every session in this process
+manager = CredentialManager()
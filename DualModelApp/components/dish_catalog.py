@@ -0,0 +1,250 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+from components import food_suggestions, dish_names
+
+logger = logging.getLogger(__name__)
+
+# Share of the daily calories planned for each meal
+MEAL_SHARES = {"breakfast": 0.25, "lunch": 0.35, "dinner": 0.40}
+# A catalog plan must land this close to the daily target, tighter than the
+# check on generated plans since the dishes are chosen for it
+CATALOG_TOLERANCE = 0.15
+# Width of the calorie bands dishes are indexed by
+CALORIE_BAND = 100
+# Dishes tried per meal slot when pairing mains with sides
+MAX_CANDIDATES = 40
+
+# Profile values that don't narrow the choice of dishes
+ANY = {None, "", "none", "other"}
+
+
+def _ids(bits):
+    # The dish ids set in a bitset, lowest first
+    while bits:
+        low = bits & -bits
+        yield low.bit_length() - 1
+        bits ^= low
+
+
+class DishCatalog:
+    """
+    Every dish from past meal plans, with inverted indexes by ingredient,
+    allergen, cuisine, category, meal time, calorie band, diet and health
+    condition. Each index entry is a Python int used as a bitset over dish ids,
+    so a constraint query is a handful of ANDs.
+
+    Cuisine, diet and condition aren't part of a dish: they come from the
+    profile whose plan the dish appeared in.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._dishes = []  # dish id -> dish dict as it appeared in a plan
+        self._ids = {}     # lowercase name -> dish id
+        self._index = {}   # facet -> value -> bitset of dish ids
+        self._loaded = set()
+        self._stats = {"plans_added": 0, "hits": 0, "misses": 0, "plan_seconds": 0.0}
+
+    def _set(self, facet, value, dish_id):
+        # Runs with _lock held
+        values = self._index.setdefault(facet, {})
+        values[value] = values.get(value, 0) | (1 << dish_id)
+
+    def _get(self, facet, value):
+        # Runs with _lock held
+        return self._index.get(facet, {}).get(value, 0)
+
+    def add_plan(self, plan, profile=None):
+        """
+        Adds the dishes of a generated plan to the catalog.
+
+        Parameters:
+        - plan (dict): A meal plan in the full format.
+        - profile (dict): The profile it was made for, which tells the cuisine,
+          diet and health conditions its dishes suit.
+        """
+        if food_suggestions.validate_meal_plan(plan):
+            return  # incomplete plans are left out
+        profile = profile or {}
+        cuisine = str(profile.get("preferred", "")).lower()
+        diet = str(profile.get("food-type", "")).lower()
+        conditions = [str(c).lower() for c in profile.get("diseases", []) if str(c).lower() not in ANY]
+        with self._lock:
+            for meal_time in food_suggestions.MEAL_TIMES:
+                for slot in food_suggestions.DISH_SLOTS:
+                    dish = plan["response"][meal_time][slot]
+                    key = dish["name"].strip().lower()
+                    dish_id = self._ids.get(key)
+                    if dish_id is None:
+                        dish_names.index.add(dish["name"])
+                        dish_id = self._ids[key] = len(self._dishes)
+                        self._dishes.append(dict(dish))
+                        self._set("category", str(dish.get("category", "")).lower(), dish_id)
+                        self._set("calorie_band", int(dish["calories"]) // CALORIE_BAND, dish_id)
+                        for ingredient in dish.get("ingredients", []):
+                            self._set("ingredient", str(ingredient).strip().lower(), dish_id)
+                        for allergy in food_suggestions.find_allergens(dish, food_suggestions.ALLERGEN_KEYWORDS):
+                            self._set("allergen", allergy, dish_id)
+                    # A dish seen again may suit another meal, cuisine or profile as well
+                    self._set("meal_time", meal_time, dish_id)
+                    self._set("slot", slot, dish_id)
+                    if cuisine not in ANY:
+                        self._set("cuisine", cuisine, dish_id)
+                    if diet not in ANY:
+                        self._set("diet", diet, dish_id)
+                    for condition in conditions:
+                        self._set("condition", condition, dish_id)
+            self._stats["plans_added"] += 1
+
+    def load_jsonl(self, path):
+        """
+        Adds the plans from a batch_meal_plans.py output file, once per path.
+
+        Returns:
+        - int: The number of plans added.
+        """
+        with self._lock:
+            if path in self._loaded:
+                return 0
+            self._loaded.add(path)
+        added = 0
+        with open(path, encoding="utf-8") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if record.get("status") == "ok" and record.get("plan"):
+                    self.add_plan(record["plan"], record.get("profile"))
+                    added += 1
+        logger.info("Loaded %d plans into the dish catalog from %s", added, path)
+        return added
+
+    def find(self, profile, meal_time=None, slot=None, calories=None):
+        """
+        Returns the dishes that suit a profile, optionally narrowed to a meal
+        time, a dish slot and a (low, high) calorie range.
+
+        Returns:
+        - list: Dish dicts.
+        """
+        with self._lock:
+            return [self._dishes[i] for i in _ids(self._match(profile, meal_time, slot, calories))]
+
+    def _match(self, profile, meal_time, slot, calories):
+        # Runs with _lock held
+        bits = (1 << len(self._dishes)) - 1
+        if meal_time:
+            bits &= self._get("meal_time", meal_time)
+        if slot:
+            bits &= self._get("slot", slot)
+        cuisine = str(profile.get("preferred", "")).lower()
+        if cuisine not in ANY:
+            bits &= self._get("cuisine", cuisine)
+        diet = str(profile.get("food-type", "")).lower()
+        if diet not in ANY:
+            bits &= self._get("diet", diet)
+        for condition in profile.get("diseases", []):
+            if str(condition).lower() not in ANY:
+                bits &= self._get("condition", str(condition).lower())
+        for allergy in profile.get("allergies", []):
+            bits &= ~self._get("allergen", allergy)
+        if calories:
+            low, high = calories
+            bands = 0
+            for band in range(int(low) // CALORIE_BAND, int(high) // CALORIE_BAND + 1):
+                bands |= self._get("calorie_band", band)
+            bits &= bands
+        return bits
+
+    def plan(self, profile, target_calories):
+        """
+        Puts a day's plan together from catalog dishes: for each meal, a main
+        and a side that suit the profile and add up to that meal's share of
+        the target, with no dish used twice.
+
+        Parameters:
+        - profile (dict): The profile, with the same fields as the form.
+        - target_calories (int): The daily energy target.
+
+        Returns:
+        - dict: A plan in the full format, or None if the catalog can't
+          satisfy the profile and the model has to plan it.
+        """
+        started = time.monotonic()
+        plan = self._plan(profile, target_calories)
+        allergies = [a for a in profile.get("allergies", []) if a != "None"]
+        if plan is not None and food_suggestions.validate_meal_plan(plan, allergies):
+            plan = None
+        with self._lock:
+            self._stats["hits" if plan else "misses"] += 1
+            self._stats["plan_seconds"] += time.monotonic() - started
+        return plan
+
+    def _plan(self, profile, target_calories):
+        response, used, total = {}, set(), 0
+        with self._lock:
+            for meal_time, share in MEAL_SHARES.items():
+                meal_target = target_calories * share
+                # Neither dish of a meal can be worth more than the whole meal
+                calories = (0, meal_target * (1 + CATALOG_TOLERANCE))
+                mains, sides = (
+                    [i for i in _ids(self._match(profile, meal_time, slot, calories)) if i not in used]
+                    for slot in food_suggestions.DISH_SLOTS
+                )
+                if not mains or not sides:
+                    return None
+                mains = random.sample(mains, min(len(mains), MAX_CANDIDATES))
+                sides = random.sample(sides, min(len(sides), MAX_CANDIDATES))
+                pairs = [
+                    (abs(self._dishes[m]["calories"] + self._dishes[s]["calories"] - meal_target), m, s)
+                    for m in mains for s in sides if m != s
+                ]
+                if not pairs:
+                    return None
+                # Any pair close enough will do, which keeps repeat plans varied
+                close = [p for p in pairs if p[0] <= CATALOG_TOLERANCE * meal_target] or [min(pairs)]
+                _, main, side = random.choice(close)
+                used.update((main, side))
+                total += self._dishes[main]["calories"] + self._dishes[side]["calories"]
+                response[meal_time] = {"main_dish": dict(self._dishes[main]), "side_dish": dict(self._dishes[side])}
+        if abs(total - target_calories) > CATALOG_TOLERANCE * target_calories:
+            return None
+        return {"response": response}
+
+    def stats(self):
+        """
+        Returns the catalog size, index sizes and how often plans came from it.
+        """
+        with self._lock:
+            attempts = self._stats["hits"] + self._stats["misses"]
+            return {
+                "dishes": len(self._dishes),
+                "index_entries": {facet: len(values) for facet, values in self._index.items()},
+                "plans_added": self._stats["plans_added"],
+                "hits": self._stats["hits"],
+                "misses": self._stats["misses"],
+                "mean_plan_ms": round(self._stats["plan_seconds"] / attempts * 1000, 2) if attempts else None,
+            }
+
+
+# One catalog shared by every session in this process
+catalog = DishCatalog()
+
+# Batch outputs to start the catalog from, separated by os.pathsep
+CATALOG_SEED_PATHS = os.environ.get("DISH_CATALOG_PATH", "")
+
+
+def seed():
+    """
+    Loads the batch outputs listed in DISH_CATALOG_PATH into the catalog, once.
+    """
+    for path in filter(None, CATALOG_SEED_PATHS.split(os.pathsep)):
+        try:
+            catalog.load_jsonl(path)
+        except OSError as e:
+            logger.warning("Couldn't load dish catalog seed %s: %s", path, e)
@@ -0,0 +1,163 @@
+import bisect
+import re
+import threading
+import time
+
+# Suggestions shown for a typed dish name
+SUGGESTION_LIMIT = 8
+# Dice similarity of character trigrams a name needs to be suggested
+MIN_SIMILARITY = 0.3
+# Names starting with the typed text rank above the rest by this much
+PREFIX_BONUS = 0.5
+# Keys this short share their few trigrams with most names, so they are only matched as prefixes
+SHORT_KEY = 2
+# Most name ids read from the trigram postings per lookup, rarest trigrams first
+MAX_POSTINGS_SCANNED = 3000
+# Most prefix matches collected per lookup
+MAX_PREFIX_MATCHES = 200
+
+
+def normalize(name):
+    """
+    Returns the name lowercased with punctuation and extra spaces removed:
+    " Mont-Hin Gar! " -> "mont hin gar".
+    """
+    return " ".join(re.findall(r"[a-z0-9]+", name.lower()))
+
+
+def _trigrams(text):
+    # Spaces are left out, so "mont hin gar" and "monthingar" share every trigram
+    padded = f"  {text.replace(' ', '')} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class DishNameIndex:
+    """
+    Known dish names, from generated plans and the dish catalog, with a
+    trigram index for misspellings and a sorted word list for prefixes. Used
+    to suggest names as the user types and to pick the one spelling the
+    caches are keyed on.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._names = []     # name id -> canonical name, as first seen
+        self._keys = []      # name id -> normalized name
+        self._ids = {}       # normalized name -> name id
+        self._grams = []     # name id -> set of trigrams
+        self._postings = {}  # trigram -> list of name ids
+        self._words = []     # sorted (word, name id), for prefix matches
+        self._stats = {"suggestions": 0, "seconds": 0.0}
+
+    def add(self, name):
+        """
+        Adds a dish name, unless a name with the same normalized form is known.
+        """
+        key = normalize(name or "")
+        if not key:
+            return
+        with self._lock:
+            if key in self._ids:
+                return
+            name_id = self._ids[key] = len(self._names)
+            self._names.append(" ".join(name.split()))
+            self._keys.append(key)
+            grams = _trigrams(key)
+            self._grams.append(grams)
+            for gram in grams:
+                self._postings.setdefault(gram, []).append(name_id)
+            for word in key.split():
+                bisect.insort(self._words, (word, name_id))
+
+    def _similar(self, key):
+        # Runs with _lock held. Dice similarity of the key's trigrams to each name sharing one.
+        # Candidates come from the rarest trigrams until MAX_POSTINGS_SCANNED ids are read, so a
+        # common trigram like " ch" doesn't drag in thousands of names; a name sharing only
+        # common trigrams with the key is too far from it to suggest anyway.
+        grams = _trigrams(key)
+        postings = sorted((self._postings.get(gram, ()) for gram in grams), key=len)
+        candidates, scanned = set(), 0
+        for ids in postings:
+            if candidates and scanned + len(ids) > MAX_POSTINGS_SCANNED:
+                break
+            candidates.update(ids)
+            scanned += len(ids)
+        return {
+            name_id: 2 * len(grams & self._grams[name_id]) / (len(grams) + len(self._grams[name_id]))
+            for name_id in candidates
+        }
+
+    def _prefixed(self, key):
+        # Runs with _lock held. Names in which the key starts at a word, the last word possibly unfinished.
+        last_word = key.split()[-1]
+        found = set()
+        start = bisect.bisect_left(self._words, (last_word, -1))
+        for word, name_id in self._words[start:]:
+            if not word.startswith(last_word):
+                break
+            if f" {key}" in f" {self._keys[name_id]}":
+                found.add(name_id)
+                if len(found) >= MAX_PREFIX_MATCHES:
+                    break
+        return found
+
+    def suggest(self, text, limit=SUGGESTION_LIMIT):
+        """
+        Returns known dish names that match typed text, best first: names
+        starting with it, then names spelled similarly.
+
+        Parameters:
+        - text (str): What the user typed so far.
+        - limit (int): Most names returned.
+
+        Returns:
+        - list: Canonical dish names.
+        """
+        key = normalize(text or "")
+        if not key:
+            return []
+        started = time.monotonic()
+        with self._lock:
+            if len(key.replace(" ", "")) <= SHORT_KEY:
+                scores = {}
+            else:
+                scores = {name_id: score for name_id, score in self._similar(key).items() if score >= MIN_SIMILARITY}
+            for name_id in self._prefixed(key):
+                scores[name_id] = scores.get(name_id, 0.0) + PREFIX_BONUS
+            ranked = sorted(scores, key=lambda name_id: (-scores[name_id], len(self._keys[name_id])))
+            ranked = [self._names[name_id] for name_id in ranked[:limit]]
+            self._stats["suggestions"] += 1
+            self._stats["seconds"] += time.monotonic() - started
+        return ranked
+
+    def canonical(self, name):
+        """
+        Returns the known spelling of a dish name when it matches one once
+        normalized, else the name itself tidied up. Similar names are never
+        substituted: "Chicken Curry" is a different dish from "Chicken Curry
+        Rice", so near matches are only offered through suggest().
+        """
+        key = normalize(name or "")
+        if not key:
+            return name
+        with self._lock:
+            if key in self._ids:
+                return self._names[self._ids[key]]
+        return " ".join(name.split())
+
+    def stats(self):
+        """
+        Returns the number of names and trigrams, and the mean time per suggestion lookup.
+        """
+        with self._lock:
+            lookups = self._stats["suggestions"]
+            return {
+                "names": len(self._names),
+                "trigrams": len(self._postings),
+                "suggestions": lookups,
+                "mean_suggestion_ms": round(self._stats["seconds"] / lookups * 1000, 3) if lookups else None,
+            }
+
+
+# One index shared by every session in this process
+index = DishNameIndex()
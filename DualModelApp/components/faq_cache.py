@@ -0,0 +1,128 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+
+# Answers to opening chat questions, reused for near-identical questions.
+# Only first turns are cached: later turns depend on the conversation so far.
+FAQ_TTL_SECONDS = 6 * 3600
+FAQ_CACHE_SIZE = 500
+# Dice similarity of character trigrams needed to reuse an answer...
+MATCH_THRESHOLD = 0.85
+# ...and every content word must pair, in the same order, with one in the other
+# question at least this close, so a typo matches but "eggs" never stands in for
+# "eels" and "brown rice healthier than white rice" never for the reverse
+WORD_MATCH_THRESHOLD = 0.6
+# Longer messages are rarely asked twice, so they aren't cached
+MAX_QUESTION_WORDS = 20
+
+# Words that don't change what is being asked. Negations are deliberately kept.
+STOPWORDS = {
+    "a", "an", "the", "is", "are", "was", "be", "it", "its", "this", "that", "of", "for", "to",
+    "in", "on", "me", "my", "i", "you", "your", "please", "can", "could", "would", "tell",
+    "how", "what", "does", "do", "about", "really", "much", "very",
+}
+
+# A question with a negation only matches questions with the same negations.
+# Words with digits ("100g", "b12") must match exactly as well.
+NEGATIONS = {"not", "no", "never", "without", "isn't", "aren't", "don't", "doesn't", "shouldn't", "can't", "avoid"}
+
+_lock = threading.Lock()
+_entries = OrderedDict()  # (provider, normalized question) -> (trigrams, answer, stored_at)
+_stats = {"hits": 0, "misses": 0, "stores": 0, "expired": 0}
+
+
+def normalize(question):
+    """
+    Returns the question as its content words in order, so case, punctuation
+    and filler words don't matter:
+    "How healthy is Mohinga?" -> "healthy mohinga".
+    """
+    words = (w.strip("'") for w in re.findall(r"[a-z0-9']+", question.lower()))
+    return " ".join(w for w in words if w and w not in STOPWORDS)
+
+
+def _trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _similarity(a, b):
+    return 2 * len(a & b) / (len(a) + len(b)) if a or b else 1.0
+
+
+def _exact_words(words):
+    # The words that can't be fuzzy-matched: negations and anything with a number in it
+    return {w for w in words if w in NEGATIONS or any(c.isdigit() for c in w)}
+
+
+def _words_pair_up(a, b):
+    # True if every word of each question has a close counterpart in the other, in the same order
+    grams = {word: _trigrams(word) for word in set(a) | set(b)}
+    for ours, theirs in ((a, b), (b, a)):
+        position = 0
+        for word in ours:
+            while position < len(theirs) and _similarity(grams[word], grams[theirs[position]]) < WORD_MATCH_THRESHOLD:
+                position += 1
+            if position == len(theirs):
+                return False
+    return True
+
+
+def lookup(question, provider):
+    """
+    Returns a cached answer from the same provider for a question close
+    enough to one answered before, or None.
+    """
+    key = normalize(question)
+    if not key:
+        return None
+    grams = _trigrams(key)
+    words = key.split()
+    exact = _exact_words(words)
+    now = time.monotonic()
+    with _lock:
+        best, best_score = None, 0.0
+        for entry_key, (stored_grams, answer, stored_at) in list(_entries.items()):
+            if now - stored_at > FAQ_TTL_SECONDS:
+                del _entries[entry_key]
+                _stats["expired"] += 1
+                continue
+            stored_provider, stored_key = entry_key
+            if stored_provider != provider:
+                continue
+            stored_words = stored_key.split()
+            if _exact_words(stored_words) != exact:
+                continue
+            score = 1.0 if stored_key == key else _similarity(grams, stored_grams)
+            if score > best_score and (score == 1.0 or _words_pair_up(words, stored_words)):
+                best, best_score = entry_key, score
+        if best is None or best_score < MATCH_THRESHOLD:
+            _stats["misses"] += 1
+            return None
+        _entries.move_to_end(best)
+        _stats["hits"] += 1
+        return _entries[best][1]
+
+
+def store(question, answer, provider):
+    """
+    Remembers a provider's answer to an opening question, unless the question
+    is too long to be a common one.
+    """
+    if not answer or len(question.split()) > MAX_QUESTION_WORDS:
+        return
+    key = normalize(question)
+    if not key:
+        return
+    with _lock:
+        _entries[(provider, key)] = (_trigrams(key), answer, time.monotonic())
+        _entries.move_to_end((provider, key))
+        while len(_entries) > FAQ_CACHE_SIZE:
+            _entries.popitem(last=False)
+        _stats["stores"] += 1
+
+
+def get_stats():
+    with _lock:
+        return {**_stats, "size": len(_entries)}
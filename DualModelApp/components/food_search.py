@@ -0,0 +1,112 @@
+import contextvars
+import json
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from components import food_suggestions, image_searchings, json_repair, router
+
+# "Search your own Food" runs as a pipeline: detection first (photos only), then
+# the description and the reference picture for the name, side by side.
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="food-search")
+
+STAGES = ("detection", "description", "picture", "total")
+# Timings remembered per stage for the metrics
+TIMINGS_KEPT = 200
+
+_lock = threading.Lock()
+_timings = {stage: deque(maxlen=TIMINGS_KEPT) for stage in STAGES}
+_stats = {"searches": 0, "from_photo": 0, "from_text": 0}
+
+
+def record(stage, seconds):
+    """
+    Records how long one stage took.
+    """
+    with _lock:
+        _timings[stage].append(seconds)
+
+
+@contextmanager
+def timed(stage, timings):
+    """
+    Times the block as `stage`, keeping the duration in `timings` for the page
+    and in the stage metrics.
+    """
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        timings[stage] = time.monotonic() - started
+        record(stage, timings[stage])
+
+
+def _describe(food_name):
+    text = food_suggestions.suggestion_from_image(food_name)
+    if not text:
+        return None
+    try:
+        data = json_repair.parse_model_json(text)
+    except json.JSONDecodeError:
+        return {"notes": text}  # a plain-text description is still worth showing
+    return data.get("response", data) if isinstance(data, dict) else {"notes": text}
+
+
+def _picture(food_name, engine):
+    url = image_searchings.fetch_cached(food_name, engine)
+    if url is None:
+        return None
+    return image_searchings.download_image(url)
+
+
+def _run_timed(stage, timings, work, *args):
+    with timed(stage, timings):
+        return work(*args)
+
+
+def start(food_name, engine, timings, from_photo, with_picture=True):
+    """
+    Starts the description and the picture search for a dish at the same
+    time, in the caller's request context.
+
+    Parameters:
+    - food_name (str): The detected or typed dish name.
+    - engine (str): "Unsplash" or "Google".
+    - timings (dict): Stage durations in seconds, filled in as stages finish.
+    - from_photo (bool): Whether the name came from a photo.
+    - with_picture (bool): False skips the picture search (lite mode).
+
+    Returns:
+    - dict: {"description": Future of dict or None, "picture": Future of image bytes or None},
+      without "picture" when it was skipped.
+    """
+    with _lock:
+        _stats["searches"] += 1
+        _stats["from_photo" if from_photo else "from_text"] += 1
+    futures = {
+        "description": _executor.submit(contextvars.copy_context().run, _run_timed, "description", timings, _describe, food_name),
+    }
+    if with_picture:
+        futures["picture"] = _executor.submit(
+            contextvars.copy_context().run, _run_timed, "picture", timings, _picture, food_name, engine
+        )
+    return futures
+
+
+def get_stats():
+    """
+    Returns the number of searches and p50/p95 seconds per stage.
+    """
+    with _lock:
+        return {
+            **_stats,
+            "stages": {
+                stage: {
+                    "count": len(values),
+                    "p50": round(router.percentile(values, 0.5), 3) if values else None,
+                    "p95": round(router.percentile(values, 0.95), 3) if values else None,
+                }
+                for stage, values in _timings.items()
+            },
+        }
@@ -1,10 +1,211 @@
+import copy
 import openai
 import json
 import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 import openai
 import google.generativeai as genai
 import os
+import threading
+import time
+from collections import OrderedDict
+from components import json_repair, rate_limits, scheduler, compact_schema, nutrition, request_context, circuit_breaker, metering, credentials, dish_names
+
+OPENAI_MEAL_PLAN_MODEL = "gpt-4o-2024-08-06"
+GEMINI_MEAL_PLAN_MODEL = "tunedModels/food-suggestion-ai-v3-t2z0eh7qpaq8"
+MEAL_PLAN_MAX_TOKENS = 1500
+
+# Time-to-plan and output size per generation mode ("full", "skeleton", "details")
+_plan_stats = {}
+_plan_stats_lock = threading.Lock()
+# Household members planned, and how many needed a single-person call after the shared request
+_household_stats = {"members": 0, "regenerated": 0}
+# Estimated output tokens of compact plans as generated, against the same plans in the full format
+_compact_stats = {"plans": 0, "full_tokens": 0, "compact_tokens": 0}
+
+def _record_plan(mode, seconds, text):
+    with _plan_stats_lock:
+        stats = _plan_stats.setdefault(mode, {"calls": 0, "seconds": 0.0, "output_tokens": 0})
+        stats["calls"] += 1
+        stats["seconds"] += seconds
+        stats["output_tokens"] += rate_limits.estimate_tokens(text)
+
+def get_plan_stats():
+    """
+    Returns calls, mean seconds and mean output tokens per generation mode,
+    and how often household members fell back to single-person calls.
+    """
+    with _plan_stats_lock:
+        members = _household_stats["members"]
+        full_tokens = _compact_stats["full_tokens"]
+        return {
+            **{
+                mode: {
+                    "calls": stats["calls"],
+                    "mean_seconds": stats["seconds"] / stats["calls"],
+                    "mean_output_tokens": stats["output_tokens"] / stats["calls"],
+                }
+                for mode, stats in _plan_stats.items()
+            },
+            "household_fallback_rate": _household_stats["regenerated"] / members if members else None,
+            "compact_token_saving": 1 - _compact_stats["compact_tokens"] / full_tokens if full_tokens else None,
+        }
+
+# Last good plans per set of details, served when a new one can't be made in time
+PLAN_CACHE_SIZE = 200
+_plan_cache = OrderedDict()
+_plan_cache_lock = threading.Lock()
+
+def remember_plan(key, plans):
+    # Copies go in and out: pages edit their plans in place (swaps, loaded details)
+    plans = copy.deepcopy(plans)
+    with _plan_cache_lock:
+        _plan_cache[key] = plans
+        _plan_cache.move_to_end(key)
+        while len(_plan_cache) > PLAN_CACHE_SIZE:
+            _plan_cache.popitem(last=False)
+
+def cached_plan(key):
+    """
+    Returns the last plans remembered for these details, or None.
+
+    Parameters:
+    - key (hashable): The prompt, or the tuple of member prompts for a household.
+    """
+    with _plan_cache_lock:
+        plans = _plan_cache.get(key)
+    return copy.deepcopy(plans)
+
+# System prompt and worked example sent ahead of every OpenAI meal plan request
+MEAL_PLAN_FEW_SHOT = [
+    {"role": "system", "content": "You are a meal planner AI, and you'll strictly need to respond with the JSON format that I provided earlier. THE OUTPUT IS JSON FORMAT"},
+    {"role": "user", "content": """{
+        "weight": 70,
+        "height": 180,
+        "age": 30,
+        "diseases": ["None"],
+        "allergies": ["None"],
+        "gender": "Male",
+        "exercise": "High"
+        "preferred": ["None"],
+        "food type": ["Healthy"]
+    }"""},
+    {"role": "assistant", "content": """{
+    "response": {
+        "breakfast": {
+        "main_dish": {
+            "name": "Oatmeal with Fresh Berries",
+            "calories": 350,
+            "category": "Healthy",
+            "ingredients": ["Oats", "Milk", "Strawberries", "Blueberries", "Honey"],
+            "how_to_cook": "Combine oats with milk and cook over medium heat until thickened. Top with fresh berries and a drizzle of honey.",
+            "meal_time": "07:00 AM"
+        },
+        "side_dish": {
+            "name": "Greek Yogurt with Almonds",
+            "calories": 150,
+            "category": "Protein",
+            "ingredients": ["Greek Yogurt", "Almonds", "Honey"],
+            "how_to_cook": "Top Greek yogurt with chopped almonds and a drizzle of honey.",
+            "meal_time": "07:00 AM"
+        }
+        },
+        "lunch": {
+        "main_dish": {
+            "name": "Grilled Chicken Salad",
+            "calories": 450,
+            "category": "Protein",
+            "ingredients": ["Chicken Breast", "Mixed Greens", "Cherry Tomatoes", "Cucumber", "Olive Oil", "Lemon Juice"],
+            "how_to_cook": "Grill chicken breast until fully cooked, then slice. Toss with mixed greens, cherry tomatoes, cucumber, and a dressing of olive oil and lemon juice.",
+            "meal_time": "12:00 PM"
+        },
+        "side_dish": {
+            "name": "Quinoa Salad",
+            "calories": 200,
+            "category": "Grain",
+            "ingredients": ["Quinoa", "Black Beans", "Corn", "Red Bell Pepper", "Lime Juice", "Cilantro"],
+            "how_to_cook": "Cook quinoa according to package instructions. Mix with black beans, corn, diced red bell pepper, lime juice, and cilantro.",
+            "meal_time": "12:00 PM"
+        }
+        },
+        "dinner": {
+        "main_dish": {
+            "name": "Baked Salmon",
+            "calories": 500,
+            "category": "Protein",
+            "ingredients": ["Salmon Fillets", "Lemon", "Dill", "Olive Oil"],
+            "how_to_cook": "Place salmon fillets on a baking sheet, brush with olive oil, and season with lemon and dill. Bake at 375°F (190°C) for 15-20 minutes.",
+            "meal_time": "07:00 PM"
+        },
+        "side_dish": {
+            "name": "Steamed Broccoli",
+            "calories": 55,
+            "category": "Vegetable",
+            "ingredients": ["Broccoli Florets"],
+            "how_to_cook": "Steam broccoli florets until tender, about 5 minutes. Season with a pinch of salt if desired.",
+            "meal_time": "07:00 PM"
+        }
+        }
+    }
+    }"""},
+]
     
+def build_prompt(profile, target_calories=None):
+    """
+    Builds the model prompt from a profile with the same fields as the Streamlit form.
+
+    Parameters:
+    - profile (dict): weight, height, age, diseases, allergies, gender, exercise,
+      preferred and food-type.
+    - target_calories (int): Daily energy target from the nutrition module. When
+      given, the model is asked to plan to it instead of working it out itself.
+
+    Returns:
+    - str: The JSON-like prompt the tuned models were trained on.
+    """
+    target = f""",
+        "daily_calories": {int(target_calories)}""" if target_calories else ""
+    return f"""{{
+        "weight": {profile["weight"]},
+        "height": {profile["height"]},
+        "age": {profile["age"]},
+        "diseases": {list(profile.get("diseases", ["None"]))},
+        "allergies": {list(profile.get("allergies", ["None"]))},
+        "gender": "{profile["gender"]}",
+        "exercise": "{profile["exercise"]}",
+        "preferred": "{profile.get("preferred", "Other")}",
+        "food-type": "{profile.get("food-type", "Balanced")}"{target}
+    }}"""
+
+class PlanError(Exception):
+    """Raised with the message for the user when a plan fails off the page, e.g. in a job."""
+
+def _show_error(message, icon="😥"):
+    # Background jobs and batch runs have no page to draw on, so the message goes up to the
+    # caller instead; the job shows it when the page collects the result
+    if get_script_run_ctx(suppress_warning=True) is None:
+        raise PlanError(message)
+    st.error(f"{icon} {message}")
+
+def _openai_text(messages, model=OPENAI_MEAL_PLAN_MODEL, lane="meal_plan", max_tokens=MEAL_PLAN_MAX_TOKENS, feature=None):
+    # Waits for a scheduler slot and rate-limit capacity, then returns the raw completion text.
+    # Fails fast without queueing while the model's circuit breaker is open or the budget is spent.
+    with metering.meter("openai", model, feature or lane, str(messages)) as usage, \
+            circuit_breaker.guard("openai", model), scheduler.admit("openai", lane):
+        rate_limits.acquire("openai", model, rate_limits.estimate_tokens(str(messages), max_tokens))
+        # A request with a deadline only waits for the time it has left
+        usage.sending()
+        response = openai.ChatCompletion.create(model=model, messages=messages, request_timeout=request_context.timeout())
+        usage.set_response(response)
+    return response['choices'][0]['message']['content']
+
+def _openai_meal_plan_text(prompt):
+    # Sends the profile along with the few-shot example
+    return _openai_text(MEAL_PLAN_FEW_SHOT + [
+        {"role": "user", "content": prompt},
+        {"role": "assistant", "content": "..."}
+    ])
+
 def generate_openai(prompt):
     """
     Generates a food suggestion using the OpenAI GPT model.
@@ -17,146 +218,490 @@ def generate_openai(prompt):
     - None: If there is an error in processing the response.
     """
     try:
-        response = openai.ChatCompletion.create(
-            model="gpt-4o-2024-08-06",
-            messages=[
-                {"role": "system", "content": "You are a meal planner AI, and you'll strictly need to respond with the JSON format that I provided earlier. THE OUTPUT IS JSON FORMAT"},
-                {"role": "user", "content": """{
-                    "weight": 70,
-                    "height": 180,
-                    "age": 30,
-                    "diseases": ["None"],
-                    "allergies": ["None"],
-                    "gender": "Male",
-                    "exercise": "High"
-                    "preferred": ["None"],
-                    "food type": ["Healthy"]
-                }"""},
-                {"role": "assistant", "content": """{
-                "response": {
-                    "breakfast": {
-                    "main_dish": {
-                        "name": "Oatmeal with Fresh Berries",
-                        "calories": 350,
-                        "category": "Healthy",
-                        "ingredients": ["Oats", "Milk", "Strawberries", "Blueberries", "Honey"],
-                        "how_to_cook": "Combine oats with milk and cook over medium heat until thickened. Top with fresh berries and a drizzle of honey.",
-                        "meal_time": "07:00 AM"
-                    },
-                    "side_dish": {
-                        "name": "Greek Yogurt with Almonds",
-                        "calories": 150,
-                        "category": "Protein",
-                        "ingredients": ["Greek Yogurt", "Almonds", "Honey"],
-                        "how_to_cook": "Top Greek yogurt with chopped almonds and a drizzle of honey.",
-                        "meal_time": "07:00 AM"
-                    }
-                    },
-                    "lunch": {
-                    "main_dish": {
-                        "name": "Grilled Chicken Salad",
-                        "calories": 450,
-                        "category": "Protein",
-                        "ingredients": ["Chicken Breast", "Mixed Greens", "Cherry Tomatoes", "Cucumber", "Olive Oil", "Lemon Juice"],
-                        "how_to_cook": "Grill chicken breast until fully cooked, then slice. Toss with mixed greens, cherry tomatoes, cucumber, and a dressing of olive oil and lemon juice.",
-                        "meal_time": "12:00 PM"
-                    },
-                    "side_dish": {
-                        "name": "Quinoa Salad",
-                        "calories": 200,
-                        "category": "Grain",
-                        "ingredients": ["Quinoa", "Black Beans", "Corn", "Red Bell Pepper", "Lime Juice", "Cilantro"],
-                        "how_to_cook": "Cook quinoa according to package instructions. Mix with black beans, corn, diced red bell pepper, lime juice, and cilantro.",
-                        "meal_time": "12:00 PM"
-                    }
-                    },
-                    "dinner": {
-                    "main_dish": {
-                        "name": "Baked Salmon",
-                        "calories": 500,
-                        "category": "Protein",
-                        "ingredients": ["Salmon Fillets", "Lemon", "Dill", "Olive Oil"],
-                        "how_to_cook": "Place salmon fillets on a baking sheet, brush with olive oil, and season with lemon and dill. Bake at 375°F (190°C) for 15-20 minutes.",
-                        "meal_time": "07:00 PM"
-                    },
-                    "side_dish": {
-                        "name": "Steamed Broccoli",
-                        "calories": 55,
-                        "category": "Vegetable",
-                        "ingredients": ["Broccoli Florets"],
-                        "how_to_cook": "Steam broccoli florets until tender, about 5 minutes. Season with a pinch of salt if desired.",
-                        "meal_time": "07:00 PM"
-                    }
-                    }
-                }
-                }"""},
-                {"role": "user", "content": prompt},
-                {"role": "assistant", "content": "..."}
-            ]
+        started = time.monotonic()
+        completion_content = _openai_meal_plan_text(prompt)
+        _record_plan("full", time.monotonic() - started, completion_content)
+        response_json = json_repair.parse_model_json(
+            completion_content, regenerate=lambda: _openai_meal_plan_text(prompt),
+            validate=validate_meal_plan
         )
-        completion_content = response['choices'][0]['message']['content']
-        response_json = json.loads(completion_content)
+        _remember_details(response_json)
         return response_json
     except json.JSONDecodeError as json_err:
-        st.error("😥 There was an error processing the response. Please try again later.")
+        _show_error("There was an error processing the response. Please try again later.")
         # st.write(json_err)
         return None
+    except circuit_breaker.CircuitOpen as down:
+        # gpt-4o is failing, the tuned model takes the same profile prompt
+        if circuit_breaker.can_route("gemini", GEMINI_MEAL_PLAN_MODEL):
+            return generate_gemini_v3(prompt)
+        _show_error(str(down), "⏳")
+        return None
+    except rate_limits.RateLimitExceeded as busy:
+        _show_error(str(busy), "⏳")
+        return None
+    except request_context.Cancelled:  # the job reports the timeout or cancellation
+        raise
     except Exception as e:
-        st.error("😥 An unexpected error occurred. Please try again.")
+        _show_error("An unexpected error occurred. Please try again.")
         # st.write(e)
         return None    
     
 
+def _gemini_text(model_name, prompt, lane="meal_plan", max_tokens=MEAL_PLAN_MAX_TOKENS, feature=None):
+    # Waits for a scheduler slot and rate-limit capacity, then returns the raw text from a tuned model.
+    # Fails fast without queueing while the model's circuit breaker is open or the budget is spent.
+    # The OAuth token is loaded and kept fresh outside the timed call, so its latency is reported apart.
+    credentials.manager.ensure()
+    with metering.meter("gemini", model_name, feature or lane, prompt) as usage, \
+            circuit_breaker.guard("gemini", model_name), scheduler.admit("gemini", lane):
+        rate_limits.acquire("gemini", model_name, rate_limits.estimate_tokens(prompt, max_tokens))
+        model = credentials.manager.model(model_name)
+        timeout = request_context.timeout()
+        request_options = {"timeout": timeout} if timeout else None
+        usage.sending()
+        response = model.generate_content(prompt, request_options=request_options)
+        usage.set_response(response)
+        return response.text
+
+def _plan_text(provider, gemini_prompt, openai_messages, max_tokens=MEAL_PLAN_MAX_TOKENS, feature=None):
+    # Sends a plan-shaped request to the provider asked for, through the same breakers as
+    # full plans: the tuned model's fallback version while v3's breaker is open, and the
+    # other provider while every option of the asked-for one is.
+    gemini_up = circuit_breaker.can_route("gemini", GEMINI_MEAL_PLAN_MODEL)
+    openai_up = circuit_breaker.available("openai", OPENAI_MEAL_PLAN_MODEL)
+    if provider == "sarrmal":
+        use_gemini = gemini_up or not openai_up
+    else:
+        use_gemini = gemini_up and not openai_up
+    if use_gemini:
+        _, model_name = circuit_breaker.route("gemini", GEMINI_MEAL_PLAN_MODEL)
+        return _gemini_text(model_name, gemini_prompt, max_tokens=max_tokens, feature=feature)
+    return _openai_text(openai_messages, max_tokens=max_tokens, feature=feature)
+
 def generate_gemini(prompt):
     try:
-        model = genai.GenerativeModel(model_name='tunedModels/food-suggestion-ai-v1-uss801z982xp')
-        result = model.generate_content(prompt)
-        response = json.loads(result.text)
+        model_name = 'tunedModels/food-suggestion-ai-v1-uss801z982xp'
+        result_text = _gemini_text(model_name, prompt)
+        response = json_repair.parse_model_json(
+            result_text, regenerate=lambda: _gemini_text(model_name, prompt),
+            validate=validate_meal_plan
+        )
         return response
     except json.JSONDecodeError as json_err:
-        st.error("😥 There was an error processing the response. Please try again later.")
+        _show_error("There was an error processing the response. Please try again later.")
         # print("There was an error processing the response. Please try again later.")
         # print(json_err)
         return None
+    except rate_limits.RateLimitExceeded as busy:
+        _show_error(str(busy), "⏳")
+        return None
+    except request_context.Cancelled:
+        raise
     except Exception as e:
-        st.error("😥 An unexpected error occurred. Please try again.")
+        _show_error("An unexpected error occurred. Please try again.")
         # st.write(e)
         return None
     
 def generate_gemini_v3(prompt):
     try:
-        model = genai.GenerativeModel(model_name='tunedModels/food-suggestion-ai-v3-t2z0eh7qpaq8')
-        result = model.generate_content(prompt)
-        cleaned_result = result.text.strip("```json").strip("```")
-        data = json.loads(cleaned_result)
+        # The older tuned version stands in while v3's circuit breaker is open
+        _, model_name = circuit_breaker.route("gemini", GEMINI_MEAL_PLAN_MODEL)
+        started = time.monotonic()
+        result_text = _gemini_text(model_name, prompt)
+        _record_plan("full", time.monotonic() - started, result_text)
+        data = json_repair.parse_model_json(
+            result_text, regenerate=lambda: _gemini_text(model_name, prompt),
+            validate=validate_meal_plan
+        )
+        _remember_details(data)
         return data
     except json.JSONDecodeError as json_err:
-        st.error("😥 There was an error processing the response. Please try again later.")
+        _show_error("There was an error processing the response. Please try again later.")
         # print("There was an error processing the response. Please try again later.")
         # print(json_err)
         return None
+    except circuit_breaker.CircuitOpen as down:
+        # Both tuned versions are failing, OpenAI plans from the same profile
+        if circuit_breaker.available("openai", OPENAI_MEAL_PLAN_MODEL):
+            return generate_openai(prompt)
+        _show_error(str(down), "⏳")
+        return None
+    except rate_limits.RateLimitExceeded as busy:
+        _show_error(str(busy), "⏳")
+        return None
+    except request_context.Cancelled:
+        raise
     except Exception as e:
-        st.error("😥 An unexpected error occurred. Please try again.")
+        _show_error("An unexpected error occurred. Please try again.")
         # st.write(e)
         return None
     
 def suggestion_from_image(prompt):
     try:
-        model = genai.GenerativeModel(model_name='tunedModels/for-food-image-to-text-v1-9kiq0o2clyrn')
-        result = model.generate_content(prompt)
+        result_text = _gemini_text('tunedModels/for-food-image-to-text-v1-9kiq0o2clyrn', prompt, lane="photo", feature="food_description")
         # cleaned_result = result.text.strip("```json").strip("```")
         # data = json.loads(cleaned_result)
-        return result.text
+        return result_text
     except json.JSONDecodeError as json_err:
         st.error("😥 There was an error processing the response. Please try again later.")
         # print("There was an error processing the response. Please try again later.")
         # print(json_err)
         return None
+    except rate_limits.RateLimitExceeded as busy:
+        st.error(f"⏳ {busy}")
+        return None
     except Exception as e:
         st.error("😥 An unexpected error occurred. Please try again.")
         # st.write(e)
         return None
 
+MEAL_TIMES = ("breakfast", "lunch", "dinner")
+DISH_SLOTS = ("main_dish", "side_dish")
+
+# Ingredient words that give an allergen away, used to check plans locally
+ALLERGEN_KEYWORDS = {
+    "Peanuts": ["peanut"],
+    "Shellfish": ["shrimp", "prawn", "crab", "lobster", "shellfish", "oyster", "mussel", "clam", "scallop"],
+    "Milk": ["milk", "cheese", "butter", "yogurt", "yoghurt", "cream", "ghee", "whey"],
+}
+
+def find_allergens(dish, allergies):
+    """
+    Returns the allergies (from the form's options) whose keywords show up in
+    a dish's name or ingredients.
+    """
+    text = " ".join([str(dish.get("name", ""))] + [str(i) for i in dish.get("ingredients", [])]).lower()
+    return [
+        allergy for allergy in allergies
+        if any(word in text for word in ALLERGEN_KEYWORDS.get(allergy, []))
+    ]
+
+def validate_meal_plan(plan, allergies=(), target_calories=None):
+    """
+    Checks that a plan has every meal and dish the page displays, that no
+    dish contains one of the listed allergens and, given a target, that the
+    calories add up to roughly the daily target.
+
+    Returns:
+    - list: Problems found, empty if the plan is usable.
+    """
+    if not isinstance(plan, dict) or not isinstance(plan.get("response"), dict):
+        return ["missing response"]
+    problems = []
+    for meal_time in MEAL_TIMES:
+        meal = plan["response"].get(meal_time)
+        if not isinstance(meal, dict):
+            problems.append(f"missing {meal_time}")
+            continue
+        for slot in DISH_SLOTS:
+            dish = meal.get(slot)
+            if not isinstance(dish, dict) or not dish.get("name"):
+                problems.append(f"missing {meal_time} {slot}")
+                continue
+            if not isinstance(dish.get("calories"), (int, float)):
+                problems.append(f"{meal_time} {slot} has no calories")
+            for allergy in find_allergens(dish, allergies):
+                problems.append(f"{meal_time} {slot} contains {allergy}")
+    if not problems and target_calories:
+        calorie_problem = nutrition.check_plan(plan, target_calories)
+        if calorie_problem:
+            problems.append(calorie_problem)
+    return problems
+
+HOUSEHOLD_INSTRUCTIONS = """Plan one day of meals for each household member below.
+Cook once for the family where you can: give members the same dish when it fits every one of their allergies, diseases and food type, and only change portions and calories.
+Respond ONLY with JSON in this format, with one entry per member in the same order:
+{"members": [{"id": "<member id>", "response": {"breakfast": {...}, "lunch": {...}, "dinner": {...}}}]}
+Each "response" uses exactly the same structure as a single meal plan."""
+
+def _household_prompt(profiles, targets):
+    members = "\n\n".join(
+        f"Member id: {profile['id']}\n{build_prompt(profile, target)}"
+        for profile, target in zip(profiles, targets)
+    )
+    return f"{HOUSEHOLD_INSTRUCTIONS}\n\n{members}"
+
+def generate_household(profiles, provider="sarrmal"):
+    """
+    Generates meal plans for several people in one structured request, then
+    falls back to single-person calls for anyone whose plan fails validation.
+
+    The shared request always goes to OpenAI: the tuned models were trained on
+    one profile per prompt and answer a household prompt with a single plan.
+    The single-person calls use the chosen provider.
+
+    Parameters:
+    - profiles (list): Profile dicts as used by build_prompt, each with an "id".
+    - provider (str): "sarrmal" for the tuned Gemini model or "openai", for the
+      single-person calls.
+
+    Returns:
+    - dict: Member id -> meal plan dict, or None where no plan could be made.
+    """
+    targets = [int(c) for c in nutrition.daily_targets_batch(profiles)["calories"]]
+    prompt = _household_prompt(profiles, targets)
+    single = generate_gemini_v3 if provider == "sarrmal" else generate_openai
+    plans = {}
+    try:
+        started = time.monotonic()
+        text = _openai_text(
+            MEAL_PLAN_FEW_SHOT + [{"role": "user", "content": prompt}],
+            max_tokens=MEAL_PLAN_MAX_TOKENS * len(profiles), feature="household",
+        )
+        _record_plan("household", time.monotonic() - started, text)
+        data = json_repair.parse_model_json(text)
+        members = data.get("members", []) if isinstance(data, dict) else []
+        for position, member in enumerate(members):
+            if not isinstance(member, dict):
+                continue
+            member_id = str(member.get("id", ""))
+            if member_id not in {str(p["id"]) for p in profiles} and position < len(profiles):
+                member_id = str(profiles[position]["id"])  # the model rewrote the id, go by order
+            plans[member_id] = {"response": member.get("response")}
+    except circuit_breaker.CircuitOpen:
+        plans = {}  # OpenAI is down, the single-person path has its own fallbacks
+    except (rate_limits.RateLimitExceeded, request_context.Cancelled):
+        raise
+    except Exception:
+        # A failed household request just means everyone goes through the single-person path
+        plans = {}
+
+    results = {}
+    for profile, target in zip(profiles, targets):
+        member_id = str(profile["id"])
+        plan = plans.get(member_id)
+        regenerate = plan is None or bool(validate_meal_plan(plan, profile.get("allergies", []), target))
+        with _plan_stats_lock:
+            _household_stats["members"] += 1
+            _household_stats["regenerated"] += regenerate
+        if regenerate:
+            plan = single(build_prompt(profile, target))
+        results[member_id] = plan
+    return results
+
+SKELETON_INSTRUCTIONS = """Plan one day of meals for the person below.
+Respond ONLY with JSON. For every dish give just the name, calories, category and meal_time, with no ingredients or cooking steps:
+{"response": {"breakfast": {"main_dish": {"name": "", "calories": 0, "category": "", "meal_time": ""}, "side_dish": {...}}, "lunch": {...}, "dinner": {...}}}"""
+
+DETAILS_PROMPT = """Give the ingredients and cooking steps for the dish "{name}".
+Respond ONLY with JSON: {{"ingredients": ["..."], "how_to_cook": "..."}}"""
+
+# Ingredients and cooking steps per dish name, filled lazily when a user opens a dish
+_dish_details = {}
+_dish_details_lock = threading.Lock()
+
+def _remember_details(plan):
+    # Full plans already carry the details, keep them for later skeleton plans
+    for meal in plan.get("response", {}).values():
+        for dish in (meal or {}).values():
+            if isinstance(dish, dict) and dish.get("name"):
+                dish_names.index.add(dish["name"])  # known names for the food search suggestions
+            if isinstance(dish, dict) and dish.get("name") and dish.get("how_to_cook"):
+                with _dish_details_lock:
+                    _dish_details.setdefault(dish["name"].strip().lower(), {
+                        "ingredients": dish.get("ingredients", []),
+                        "how_to_cook": dish.get("how_to_cook"),
+                    })
+
+def generate_skeleton(prompt, provider="sarrmal"):
+    """
+    Generates a plan with only dish names, calories, category and meal time,
+    which is much shorter to generate than a full plan. Cooking details are
+    fetched per dish with get_dish_details.
+
+    Parameters:
+    - prompt (str): The profile prompt from build_prompt.
+    - provider (str): "sarrmal" or "openai".
+
+    Returns:
+    - dict: The meal plan without ingredients and how_to_cook.
+    - None: If there is an error in processing the response.
+    """
+    try:
+        started = time.monotonic()
+        # The tuned model was trained on full plans and may ignore the
+        # instructions, in which case the details it returns are kept.
+        text = _plan_text(provider, f"{SKELETON_INSTRUCTIONS}\n\n{prompt}", [
+            {"role": "system", "content": "You are a meal planner AI. THE OUTPUT IS JSON FORMAT"},
+            {"role": "user", "content": f"{SKELETON_INSTRUCTIONS}\n\n{prompt}"},
+        ], max_tokens=400, feature="skeleton")
+        _record_plan("skeleton", time.monotonic() - started, text)
+        plan = json_repair.parse_model_json(text)
+        _remember_details(plan)
+        return plan
+    except json.JSONDecodeError as json_err:
+        _show_error("There was an error processing the response. Please try again later.")
+        return None
+    except rate_limits.RateLimitExceeded as busy:
+        _show_error(str(busy), "⏳")
+        return None
+    except request_context.Cancelled:
+        raise
+    except Exception as e:
+        _show_error("An unexpected error occurred. Please try again.")
+        return None
+
+def get_dish_details(name, provider="sarrmal"):
+    """
+    Returns {"ingredients": [...], "how_to_cook": "..."} for one dish, generated
+    on first use and then cached by dish name.
+
+    Returns:
+    - dict: The dish details.
+    - None: If they couldn't be generated.
+    """
+    key = name.strip().lower()
+    with _dish_details_lock:
+        if key in _dish_details:
+            return _dish_details[key]
+    try:
+        started = time.monotonic()
+        if provider == "sarrmal":
+            # The image-to-text model describes a named dish, ingredients and steps included
+            text = _gemini_text('tunedModels/for-food-image-to-text-v1-9kiq0o2clyrn', name, max_tokens=600, feature="dish_details")
+        else:
+            text = _openai_text([{"role": "user", "content": DETAILS_PROMPT.format(name=name)}], max_tokens=600, feature="dish_details")
+        _record_plan("details", time.monotonic() - started, text)
+        data = json_repair.parse_model_json(text)
+        data = data.get("response", data) if isinstance(data, dict) else {}
+        how_to_cook = data.get("how_to_cook", "")
+        if isinstance(how_to_cook, list):
+            how_to_cook = " ".join(str(step) for step in how_to_cook)
+        details = {"ingredients": data.get("ingredients", []), "how_to_cook": how_to_cook}
+    except rate_limits.RateLimitExceeded as busy:
+        st.error(f"⏳ {busy}")
+        return None
+    except Exception as e:
+        st.error("😥 Couldn't load the cooking details. Please try again.")
+        return None
+    with _dish_details_lock:
+        _dish_details[key] = details
+    return details
+
+# The few-shot example again, rewritten in the compact wire format
+COMPACT_FEW_SHOT = [
+    {"role": "system", "content": "You are a meal planner AI. " + compact_schema.COMPACT_INSTRUCTIONS},
+    MEAL_PLAN_FEW_SHOT[1],
+    {"role": "assistant", "content": json.dumps(
+        compact_schema.compress(json.loads(MEAL_PLAN_FEW_SHOT[2]["content"])),
+        ensure_ascii=False, separators=(",", ":")
+    )},
+]
+
+def generate_compact(prompt, provider="openai"):
+    """
+    Generates a meal plan in the compact wire format (short positional arrays,
+    no repeated keys or meal times) and expands it locally into the usual
+    structure, so far fewer output tokens have to be generated.
+
+    The tuned SarrMal model was trained on the full format, so with it the
+    instructions may be ignored; a full plan is returned unchanged in that case.
+
+    Returns:
+    - dict: The expanded meal plan.
+    - None: If there is an error in processing the response.
+    """
+    try:
+        started = time.monotonic()
+        text = _plan_text(
+            provider, f"{compact_schema.COMPACT_INSTRUCTIONS}\n\n{prompt}",
+            COMPACT_FEW_SHOT + [{"role": "user", "content": prompt}],
+            max_tokens=MEAL_PLAN_MAX_TOKENS if provider == "sarrmal" else MEAL_PLAN_MAX_TOKENS // 2, feature="compact",
+        )
+        _record_plan("compact", time.monotonic() - started, text)
+        data = json_repair.parse_model_json(text)
+        plan = compact_schema.expand(data)
+        if "response" not in data:
+            # Only plans that really came back compact count towards the saving
+            saving = compact_schema.measure(plan)
+            with _plan_stats_lock:
+                _compact_stats["plans"] += 1
+                _compact_stats["full_tokens"] += saving["full_tokens"]
+                _compact_stats["compact_tokens"] += saving["compact_tokens"]
+        _remember_details(plan)
+        return plan
+    except (json.JSONDecodeError, ValueError) as json_err:
+        _show_error("There was an error processing the response. Please try again later.")
+        return None
+    except rate_limits.RateLimitExceeded as busy:
+        _show_error(str(busy), "⏳")
+        return None
+    except request_context.Cancelled:
+        raise
+    except Exception as e:
+        _show_error("An unexpected error occurred. Please try again.")
+        return None
+
+SLOT_PROMPT = """Here is a person's profile and their meal plan for the day.
+Replace ONLY the {meal_time} {slot_label} with a different dish that suits the profile, keeps the day's calories about the same and doesn't repeat a dish already in the plan.{note}
+Respond ONLY with JSON for the one new dish:
+{{"name": "", "calories": 0, "category": "", "ingredients": [""], "how_to_cook": "", "meal_time": ""}}
+
+Profile:
+{prompt}
+
+Current plan (dish: kcal):
+{plan_summary}"""
+
+def _plan_summary(plan):
+    lines = []
+    for meal_time, meal in plan.get("response", {}).items():
+        for slot, dish in (meal or {}).items():
+            if isinstance(dish, dict):
+                lines.append(f"- {meal_time} {slot.replace('_', ' ')}: {dish.get('name')} ({dish.get('calories')} kcal)")
+    return "\n".join(lines)
+
+def regenerate_slot(plan, meal_time, slot, prompt, provider="sarrmal", note=None):
+    """
+    Generates a replacement for one dish of a plan, with the rest of the plan
+    as context, so an edit costs one short dish instead of a whole new plan.
+
+    Parameters:
+    - plan (dict): The current meal plan.
+    - meal_time (str): "breakfast", "lunch" or "dinner".
+    - slot (str): "main_dish" or "side_dish".
+    - prompt (str): The (possibly updated) profile prompt from build_prompt.
+    - provider (str): "sarrmal" or "openai".
+    - note (str): Optional extra wish from the user, e.g. "no mushrooms".
+
+    Returns:
+    - dict: The new dish.
+    - None: If there is an error in processing the response.
+    """
+    slot_prompt = SLOT_PROMPT.format(
+        meal_time=meal_time,
+        slot_label=slot.replace("_", " "),
+        note=f"\nAlso: {note}" if note else "",
+        prompt=prompt,
+        plan_summary=_plan_summary(plan),
+    )
+    try:
+        started = time.monotonic()
+        text = _plan_text(provider, slot_prompt, [
+            {"role": "system", "content": "You are a meal planner AI. THE OUTPUT IS JSON FORMAT"},
+            {"role": "user", "content": slot_prompt},
+        ], max_tokens=400, feature="slot_swap")
+        _record_plan("slot", time.monotonic() - started, text)
+        data = json_repair.parse_model_json(text)
+        if isinstance(data, dict) and "response" in data:
+            # The tuned model answers with a whole plan, keep just the asked-for slot
+            data = data["response"].get(meal_time, {}).get(slot)
+        if not isinstance(data, dict) or not data.get("name"):
+            raise ValueError("No dish in the model output")
+        data.setdefault("meal_time", plan["response"].get(meal_time, {}).get(slot, {}).get("meal_time"))
+        _remember_details({"response": {meal_time: {slot: data}}})
+        return data
+    except (json.JSONDecodeError, ValueError) as json_err:
+        st.error("😥 There was an error processing the response. Please try again later.")
+        return None
+    except rate_limits.RateLimitExceeded as busy:
+        st.error(f"⏳ {busy}")
+        return None
+    except Exception as e:
+        st.error("😥 An unexpected error occurred. Please try again.")
+        return None
+
 #For testing the models    
     
 # print(generate_gemini("""{
@@ -2,26 +2,160 @@ import streamlit as st
 import openai
 import base64
 import os
+import threading
+from collections import OrderedDict
+from io import BytesIO
+from PIL import Image, ImageOps
 from dotenv import load_dotenv
+from components import rate_limits, scheduler, circuit_breaker, metering, dish_names
 
 load_dotenv()
 
 # Initialize OpenAI with your API key
 openai.api_key = os.environ.get("OPEN_AI_API_KEY")
 
+# The food name only needs the low-detail view, which the model sees at 512x512
+VISION_DETAIL = "low"
+VISION_MAX_SIDE = 512
+JPEG_QUALITY = 85
+
+# Photos whose difference hashes are this close are treated as the same dish photo
+HASH_MAX_DISTANCE = 6
+# While the vision model's circuit breaker is open, a looser match is better than no answer
+HASH_FALLBACK_DISTANCE = 12
+HASH_CACHE_SIZE = 500
+
+_hash_cache = OrderedDict()
+_hash_cache_lock = threading.Lock()
+
+
+def preprocess_image(image, max_side=VISION_MAX_SIDE):
+    """
+    Prepares an uploaded or camera image for the vision model.
+
+    Parameters:
+    - image (file-like | PIL.Image): The uploaded file or an opened image.
+    - max_side (int): Longest side in pixels after downscaling.
+
+    Returns:
+    - PIL.Image: The upright, downscaled RGB image.
+    """
+    if not isinstance(image, Image.Image):
+        if hasattr(image, "seek"):
+            image.seek(0)
+        image = Image.open(image)
+    image = ImageOps.exif_transpose(image)  # Phone photos are often stored rotated
+    image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    return image
+
+
+def _jpeg_base64(image):
+    buffer = BytesIO()
+    image.save(buffer, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+    return base64.b64encode(buffer.getvalue()).decode("utf-8")
+
+
 def encode_image(image):
-    return base64.b64encode(image.read()).decode("utf-8")
+    """
+    Returns the preprocessed image as a base64 JPEG string.
+    """
+    return _jpeg_base64(preprocess_image(image))
+
+
+def image_hash(image, hash_size=8):
+    """
+    Computes a 64-bit difference hash, which stays the same under resizing,
+    recompression and small lighting changes.
+    """
+    if not isinstance(image, Image.Image):
+        image = preprocess_image(image)
+    small = image.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.BILINEAR)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def lookup_cached_name(hash_value, max_distance=HASH_MAX_DISTANCE):
+    # Returns the stored food name of the closest near-duplicate photo, if any
+    best_name, best_distance = None, max_distance + 1
+    with _hash_cache_lock:
+        for cached_hash, name in _hash_cache.items():
+            distance = bin(cached_hash ^ hash_value).count("1")
+            if distance < best_distance:
+                best_name, best_distance = name, distance
+                best_hash = cached_hash
+        if best_name is not None:
+            _hash_cache.move_to_end(best_hash)
+    return best_name
+
+
+def remember_name(hash_value, food_name):
+    with _hash_cache_lock:
+        _hash_cache[hash_value] = food_name
+        _hash_cache.move_to_end(hash_value)
+        while len(_hash_cache) > HASH_CACHE_SIZE:
+            _hash_cache.popitem(last=False)
+
 
 def get_food_name(base64_image):
-    response = openai.ChatCompletion.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": "When I give you a food image, you'll have to return the name of the food. If it's not food, return nothing."},
-            {"role": "user", "content": [
-                {"type": "text", "text": "What is the name of this food? return ONLY THE NAME of the food, nothing more, nothing less. If it's not food, return error."},
-                {"type": "image_url", "image_url": {
-                    "url": f"data:image/png;base64,{base64_image}"}
-                }],
-            }]
-        )
-    return response.choices[0].message['content']
\ No newline at end of file
+    # A low-detail image costs a fixed 85 tokens on top of the text
+    with metering.meter("openai", "gpt-4o", "photo", images=1) as usage, \
+            circuit_breaker.guard("openai", "gpt-4o"), scheduler.admit("openai", "photo"):
+        rate_limits.acquire("openai", "gpt-4o", 85 + 100)
+        usage.sending()
+        response = openai.ChatCompletion.create(
+            model="gpt-4o",
+            messages=[
+                {"role": "system", "content": "When I give you a food image, you'll have to return the name of the food. If it's not food, return nothing."},
+                {"role": "user", "content": [
+                    {"type": "text", "text": "What is the name of this food? return ONLY THE NAME of the food, nothing more, nothing less. If it's not food, return error."},
+                    {"type": "image_url", "image_url": {
+                        "url": f"data:image/jpeg;base64,{base64_image}",
+                        "detail": VISION_DETAIL}
+                    }],
+                }]
+            )
+        usage.set_response(response)
+    return response.choices[0].message['content']
+
+
+def detect_food(image):
+    """
+    Preprocesses an image and returns its food name, reusing the answer for
+    near-duplicates of a photo that was already classified.
+
+    Parameters:
+    - image (file-like | PIL.Image): The uploaded file or an opened image.
+
+    Returns:
+    - str: The food name returned by the vision model.
+
+    Raises:
+    - circuit_breaker.CircuitOpen: If the vision model is failing and no
+      similar photo has been classified before.
+    """
+    prepared = preprocess_image(image)
+    hash_value = image_hash(prepared)
+    cached = lookup_cached_name(hash_value)
+    if cached is not None:
+        return cached
+
+    try:
+        food_name = get_food_name(_jpeg_base64(prepared))
+    except circuit_breaker.CircuitOpen:
+        cached = lookup_cached_name(hash_value, HASH_FALLBACK_DISTANCE)
+        if cached is None:
+            raise
+        return cached
+    if food_name:
+        # The known spelling, so the description and picture caches see one name per dish
+        food_name = dish_names.index.canonical(food_name.strip())
+        remember_name(hash_value, food_name)
+    return food_name
@@ -2,18 +2,90 @@
 import requests
 import streamlit as st
 import os
+import threading
+from collections import OrderedDict
 from dotenv import load_dotenv
+from components import rate_limits, scheduler, request_context, metering
 
 load_dotenv()
 
 UNSPLASH_ACCESS_KEY = os.environ.get("UNSPLASH_ACCESS_KEY")
 UNSPLASH_ACCESS_KEY_2 = os.environ.get("UNSPLASH_ACCESS_KEY_2")
 
+# Image URLs per (engine, dish name), so reruns and repeated dishes skip the search
+URL_CACHE_SIZE = 1000
+_url_cache = OrderedDict()
+_url_cache_lock = threading.Lock()
+
+def fetch_cached(food_name, engine="Unsplash"):
+    """
+    Returns an image URL for a dish from the cache, searching with the chosen
+    engine ("Unsplash" or "Google") on a miss.
+
+    Returns:
+    str: The image URL, or None if no image was found.
+    """
+    key = (engine, food_name.strip().lower())
+    with _url_cache_lock:
+        if key in _url_cache:
+            _url_cache.move_to_end(key)
+            return _url_cache[key]
+
+    image_url = fetch_google(food_name) if engine == "Google" else fetch_unsplash(food_name)
+    if not isinstance(image_url, str):
+        return None  # fetch_google reports failures as an error dict
+    with _url_cache_lock:
+        _url_cache[key] = image_url
+        while len(_url_cache) > URL_CACHE_SIZE:
+            _url_cache.popitem(last=False)
+    return image_url
+
+def is_cached(food_name, engine="Unsplash"):
+    """
+    Returns True if the dish's image URL is already known, so showing it won't
+    need a search.
+    """
+    with _url_cache_lock:
+        return (engine, food_name.strip().lower()) in _url_cache
+
+# Downloaded image bytes per URL, so reruns don't download the same pictures again
+DOWNLOAD_CACHE_SIZE = 200
+_download_cache = OrderedDict()
+_download_cache_lock = threading.Lock()
+
+def download_image(url):
+    """
+    Downloads an image, reusing recent downloads.
+
+    Returns:
+    bytes: The image content, or None if the URL isn't an image.
+
+    Raises:
+    requests.exceptions.RequestException: If the download fails.
+    """
+    with _download_cache_lock:
+        if url in _download_cache:
+            _download_cache.move_to_end(url)
+            return _download_cache[url]
+
+    response = requests.get(url, timeout=request_context.timeout())
+    response.raise_for_status()  # Check if the request was successful
+    if 'image' not in response.headers.get('Content-Type', ''):
+        return None
+    with _download_cache_lock:
+        _download_cache[url] = response.content
+        while len(_download_cache) > DOWNLOAD_CACHE_SIZE:
+            _download_cache.popitem(last=False)
+    return response.content
+
 #Fail Save Access Key     
 def fetch_unsplash(food_name):
     def get_image(api_key):
         url = f"https://api.unsplash.com/search/photos?page=1&query={food_name}%20food&client_id={api_key}&per_page=1"
-        response = requests.get(url)
+        with metering.meter("unsplash", "search", "image_search") as usage, scheduler.admit("unsplash", "meal_plan"):
+            rate_limits.acquire("unsplash", "search")
+            usage.sending()
+            response = requests.get(url, timeout=request_context.timeout())
         
         if response.status_code == 200:
             data = response.json()
@@ -66,7 +138,10 @@ def fetch_google(search_query):
             'cx': search_engine_id,
             'searchType': 'image'
         }
-        response = requests.get(url, params=params)
+        with metering.meter("google", "customsearch", "image_search") as usage, scheduler.admit("google", "meal_plan"):
+            rate_limits.acquire("google", "customsearch")
+            usage.sending()
+            response = requests.get(url, params=params, timeout=request_context.timeout())
         if response.status_code == 200:
             result = response.json()
             if 'items' in result:
@@ -0,0 +1,170 @@
+import contextvars
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from components import request_context
+
+# Background work for the page (meal plans and their pictures). Jobs run here so
+# a rerun of the script doesn't throw the work away, and the page polls them.
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="jobs")
+
+# Finished jobs nobody collected (the tab was closed) are dropped after this long
+JOB_TTL_SECONDS = 600.0
+
+_lock = threading.Lock()
+_jobs = {}
+_ids = itertools.count(1)
+_stats = {"submitted": 0, "done": 0, "failed": 0, "cancelled": 0, "replaced": 0}
+
+
+class Job:
+    """
+    One background job. The work function gets the job as its first argument
+    and reports what it is doing with `set_stage`.
+    """
+
+    def __init__(self, session_id, kind):
+        self.id = next(_ids)
+        self.session_id = session_id
+        self.kind = kind
+        self.status = "queued"  # queued, running, done, failed or cancelled
+        self.stage = "Waiting to start..."
+        self.result = None
+        self.error = None
+        self.cancel_event = threading.Event()
+        self.future = None
+        self.submitted_at = time.monotonic()
+        self.finished_at = None
+
+    @property
+    def active(self):
+        return self.status in ("queued", "running")
+
+    @property
+    def elapsed(self):
+        return (self.finished_at or time.monotonic()) - self.submitted_at
+
+    def set_stage(self, stage):
+        self.stage = stage
+
+    def check(self):
+        """Raises request_context.Cancelled if the job has been cancelled."""
+        if self.cancel_event.is_set():
+            raise request_context.Cancelled("The job was cancelled")
+
+
+def _run(job, work, args):
+    if job.cancel_event.is_set():
+        return
+    job.status = "running"
+
+    def show_position(position):
+        job.set_stage(f"Lots of people are using SarrMal right now. You are number {position} in line...")
+
+    try:
+        with request_context.use(session_id=job.session_id, on_queue_wait=show_position,
+                                 cancel_event=job.cancel_event):
+            result = work(job, *args)
+        job.check()  # cancelled after the last provider call, so the result is dropped
+        job.result, status = result, "done"
+    except request_context.DeadlineExceeded:
+        job.error, status = "This took too long. Please try again.", "failed"
+    except request_context.Cancelled:
+        status = "cancelled"
+    except Exception as e:
+        job.error, status = str(e), "failed"
+    with _lock:
+        job.status = status
+        job.finished_at = time.monotonic()
+        if status != "cancelled":  # cancel() has already counted it
+            _stats[status] += 1
+
+
+def _prune(now):
+    # Runs with _lock held
+    for key, job in list(_jobs.items()):
+        if not job.active and now - job.finished_at > JOB_TTL_SECONDS:
+            del _jobs[key]
+
+
+def submit(session_id, kind, work, *args):
+    """
+    Starts `work(job, *args)` in the background. A session has at most one job
+    per kind: an earlier one that is still running is cancelled and replaced.
+
+    Parameters:
+    - session_id (str): The Streamlit session.
+    - kind (str): e.g. "meal_plan".
+    - work (callable): The function to run; it receives the Job first.
+
+    Returns:
+    - Job: The new job.
+    """
+    job = Job(session_id, kind)
+    with _lock:
+        _prune(time.monotonic())
+        previous = _jobs.get((session_id, kind))
+        if previous is not None and previous.active:
+            _cancel(previous)
+            _stats["replaced"] += 1
+        _jobs[(session_id, kind)] = job
+        _stats["submitted"] += 1
+    # The worker sees the same request context as the page that submitted it
+    context = contextvars.copy_context()
+    job.future = _executor.submit(context.run, _run, job, work, args)
+    return job
+
+
+def get(session_id, kind):
+    """
+    Returns the session's job of this kind, or None if there is none.
+    """
+    with _lock:
+        return _jobs.get((session_id, kind))
+
+
+def collect(session_id, kind):
+    """
+    Returns the session's job if it has finished and removes it, so its result
+    is handed to the page once. Returns None while it is still running.
+    """
+    with _lock:
+        job = _jobs.get((session_id, kind))
+        if job is None or job.active:
+            return None
+        del _jobs[(session_id, kind)]
+        return job
+
+
+def _cancel(job):
+    # Runs with _lock held. Provider queues and rate limit waits see the event and give up.
+    job.cancel_event.set()
+    job.set_stage("Cancelling...")
+    _stats["cancelled"] += 1
+    if job.future is not None and job.future.cancel():
+        job.status = "cancelled"
+        job.finished_at = time.monotonic()
+
+
+def cancel(session_id, kind):
+    """
+    Cancels the session's job of this kind if it is still running.
+
+    Returns:
+    - bool: True if a running job was cancelled.
+    """
+    with _lock:
+        job = _jobs.get((session_id, kind))
+        if job is None or not job.active or job.cancel_event.is_set():
+            return False
+        _cancel(job)
+        return True
+
+
+def get_stats():
+    with _lock:
+        stats = dict(_stats)
+        stats["running"] = sum(1 for job in _jobs.values() if job.status == "running")
+        stats["queued"] = sum(1 for job in _jobs.values() if job.status == "queued")
+        return stats
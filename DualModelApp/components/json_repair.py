@@ -0,0 +1,263 @@
+import json
+import re
+import threading
+
+# Counters for how model output was turned into JSON
+_stats = {"clean": 0, "repaired": 0, "regenerated": 0, "incomplete": 0, "failed": 0}
+_stats_lock = threading.Lock()
+
+_FENCE_RE = re.compile(r"```(?:json|JSON)?\s*(.*?)(?:```|$)", re.DOTALL)
+_TRAILING_COMMA_RE = re.compile(r",\s*([}\]])")
+_PY_LITERALS = {"True": "true", "False": "false", "None": "null"}
+
+
+def _count(outcome):
+    with _stats_lock:
+        _stats[outcome] += 1
+
+
+def get_stats():
+    """
+    Returns how many model outputs parsed cleanly, needed a local repair,
+    needed a regeneration, or could not be parsed at all.
+    """
+    with _stats_lock:
+        return dict(_stats)
+
+
+def reset_stats():
+    with _stats_lock:
+        for key in _stats:
+            _stats[key] = 0
+
+
+def extract_json(text):
+    """
+    Locates the JSON object (or array) inside a model response.
+
+    Parameters:
+    - text (str): The raw model output, possibly wrapped in code fences or prose.
+
+    Returns:
+    - str: The text from the first opening bracket to its matching close, or to
+      the end of the text if the output was truncated.
+    """
+    fenced = _FENCE_RE.search(text)
+    if fenced and ("{" in fenced.group(1) or "[" in fenced.group(1)):
+        text = fenced.group(1)
+
+    starts = [i for i in (text.find("{"), text.find("[")) if i != -1]
+    if not starts:
+        return text.strip()
+    start = min(starts)
+
+    depth = 0
+    quote = None
+    escaped = False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if quote:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == quote:
+                quote = None
+        elif ch in "\"'":
+            quote = ch
+        elif ch in "{[":
+            depth += 1
+        elif ch in "}]":
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return text[start:].strip()
+
+
+def _normalize_quotes(text):
+    # Rewrites single-quoted strings and Python literals into valid JSON
+    out = []
+    quote = None
+    escaped = False
+    i = 0
+    while i < len(text):
+        ch = text[i]
+        if quote:
+            if escaped:
+                escaped = False
+                if quote == "'" and ch == "'":
+                    out[-1] = "'"  # \' is not a valid JSON escape
+                else:
+                    out.append(ch)
+            elif ch == "\\":
+                escaped = True
+                out.append(ch)
+            elif ch == quote:
+                quote = None
+                out.append('"')
+            elif ch == '"' and quote == "'":
+                out.append('\\"')
+            elif ch == "\n":
+                out.append("\\n")
+            else:
+                out.append(ch)
+        elif ch in "\"'":
+            quote = ch
+            out.append('"')
+        elif ch.isalpha():
+            j = i
+            while j < len(text) and text[j].isalpha():
+                j += 1
+            word = text[i:j]
+            out.append(_PY_LITERALS.get(word, word))
+            i = j
+            continue
+        else:
+            out.append(ch)
+        i += 1
+    return "".join(out)
+
+
+def _close_brackets(text):
+    # Closes any string and brackets left open by a truncated response
+    stack = []
+    quote = False
+    escaped = False
+    for ch in text:
+        if quote:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                quote = False
+        elif ch == '"':
+            quote = True
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+        elif ch in "}]" and stack:
+            stack.pop()
+    if quote:
+        text += '"'
+    text = text.rstrip()
+    if text.endswith(":"):
+        text += " null"
+    text = text.rstrip(",")
+    return text + "".join(reversed(stack))
+
+
+def _cut_points(text):
+    # Positions of top-level-ish commas, last first, for dropping a partial element
+    points = []
+    quote = False
+    escaped = False
+    for i, ch in enumerate(text):
+        if quote:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                quote = False
+        elif ch == '"':
+            quote = True
+        elif ch == ",":
+            points.append(i)
+    return reversed(points[-20:])
+
+
+def repair_json(text):
+    """
+    Fixes the common defects seen in model JSON: code fences, surrounding prose,
+    trailing commas, single quotes, Python literals and unclosed brackets.
+
+    Parameters:
+    - text (str): The raw model output.
+
+    Returns:
+    - str: A repaired JSON string (not guaranteed to parse).
+    """
+    candidate = _normalize_quotes(extract_json(text))
+    candidate = _TRAILING_COMMA_RE.sub(r"\1", _close_brackets(candidate))
+    try:
+        json.loads(candidate)
+        return candidate
+    except json.JSONDecodeError:
+        pass
+
+    # A truncated element (e.g. a dangling key) can't be completed, so drop it
+    for cut in _cut_points(candidate):
+        shortened = _TRAILING_COMMA_RE.sub(r"\1", _close_brackets(candidate[:cut]))
+        try:
+            json.loads(shortened)
+            return shortened
+        except json.JSONDecodeError:
+            continue
+    return candidate
+
+
+def loads(text):
+    """
+    Parses model output as JSON, repairing it locally when needed.
+
+    Returns:
+    - tuple: (data, repaired) where repaired tells whether a fix was applied.
+
+    Raises:
+    - json.JSONDecodeError: If the output can't be repaired.
+    """
+    try:
+        return json.loads(text), False
+    except (json.JSONDecodeError, TypeError):
+        pass
+    try:
+        return json.loads(extract_json(text)), True
+    except json.JSONDecodeError:
+        pass
+    return json.loads(repair_json(text)), True
+
+
+def parse_model_json(text, regenerate=None, max_regenerations=1, validate=None):
+    """
+    Parses model output as JSON, trying local repair before asking for a new
+    generation.
+
+    Parameters:
+    - text (str): The raw model output.
+    - regenerate (callable): Optional function returning a fresh model output.
+    - max_regenerations (int): How many fresh outputs to try after repair fails.
+    - validate (callable): Optional check returning a list of problems. A
+      repaired result with problems (e.g. a truncated plan that lost a meal)
+      counts as a failed repair and is regenerated while attempts remain.
+
+    Returns:
+    - dict | list: The parsed JSON. If every attempt needed repair and failed
+      validation, the last one.
+
+    Raises:
+    - json.JSONDecodeError: If neither repair nor regeneration gives valid JSON.
+    """
+    attempts = max_regenerations if regenerate else 0
+    for attempt in range(attempts + 1):
+        try:
+            data, repaired = loads(text)
+        except json.JSONDecodeError:
+            if attempt == attempts:
+                _count("failed")
+                raise
+            text = regenerate()
+            continue
+        if repaired and validate is not None and validate(data):
+            # Repair closed the JSON but content was lost
+            if attempt < attempts:
+                text = regenerate()
+                continue
+            _count("incomplete")
+            return data
+        if attempt:
+            _count("regenerated")
+        elif repaired:
+            _count("repaired")
+        else:
+            _count("clean")
+        return data
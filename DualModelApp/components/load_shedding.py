@@ -0,0 +1,109 @@
+import logging
+import statistics
+import threading
+import time
+from collections import deque
+from components import scheduler, router
+
+logger = logging.getLogger(__name__)
+
+# Lite mode starts when this many calls are waiting for a provider slot, or a
+# model's rolling p95 latency goes over this multiple of its usual p95...
+ENTER_QUEUE_DEPTH = 10
+ENTER_SLOWDOWN = 2.0
+# ...and ends once both are back under these and it has lasted MIN_LITE_SECONDS,
+# so the page doesn't flip back and forth at the threshold.
+EXIT_QUEUE_DEPTH = 3
+EXIT_SLOWDOWN = 1.3
+MIN_LITE_SECONDS = 60.0
+
+# A model's usual p95 is the median of its last BASELINE_READINGS p95 readings
+# (one per check, about an hour's worth) taken outside lite mode. Each model is
+# judged against its own: a full plan taking 25s is normal, a chat reply isn't.
+BASELINE_READINGS = 1800
+MIN_BASELINE_READINGS = 30
+
+# The signals are read at most this often, however many pages ask
+CHECK_INTERVAL_SECONDS = 2.0
+
+# Longest chat reply while in lite mode
+CHAT_MAX_TOKENS_LITE = 256
+
+_lock = threading.Lock()
+_state = {"lite": False, "since": time.monotonic(), "reason": None, "checked_at": 0.0,
+          "queue_depth": 0, "slowdown": None}
+_baselines = {}  # model -> recent p95 readings
+_stats = {"entered": 0, "left": 0}
+
+
+def _signals(learn):
+    # Returns the queue depth and the slowest model as (its p95 over its usual p95, name).
+    # With `learn`, the readings also go into the baselines.
+    queue_depth = sum(
+        sum(queue["waiting"].values()) for queue in scheduler.get_stats().values()
+    )
+    slowest = None
+    for name, model in router.get_stats()["models"].items():
+        if model["p95"] is None or model["samples"] < router.MIN_SAMPLES:
+            continue
+        with _lock:
+            readings = _baselines.setdefault(name, deque(maxlen=BASELINE_READINGS))
+            usual = statistics.median(readings) if len(readings) >= MIN_BASELINE_READINGS else None
+            if learn:
+                readings.append(model["p95"])
+        if usual:
+            slowdown = model["p95"] / usual
+            if slowest is None or slowdown > slowest[0]:
+                slowest = (slowdown, name)
+    return queue_depth, slowest
+
+
+def is_lite():
+    """
+    Returns True while the service is overloaded and should serve the lite
+    experience: cached or compact plans, no image searches and short chat replies.
+    """
+    now = time.monotonic()
+    with _lock:
+        if now - _state["checked_at"] < CHECK_INTERVAL_SECONDS:
+            return _state["lite"]
+        _state["checked_at"] = now
+        learn = not _state["lite"]  # overloaded latency isn't what the models usually take
+    queue_depth, slowest = _signals(learn)
+    slowdown = slowest[0] if slowest else None
+    with _lock:
+        _state["queue_depth"], _state["slowdown"] = queue_depth, slowdown and round(slowdown, 2)
+        slow = slowdown is not None and slowdown > ENTER_SLOWDOWN
+        if not _state["lite"] and (queue_depth >= ENTER_QUEUE_DEPTH or slow):
+            if queue_depth >= ENTER_QUEUE_DEPTH:
+                reason = f"{queue_depth} calls waiting"
+            else:
+                reason = f"{slowest[1]} p95 latency {slowdown:.1f}x its usual"
+            logger.warning("Entering lite mode: %s", reason)
+            _state.update(lite=True, since=now, reason=reason)
+            _stats["entered"] += 1
+        elif (_state["lite"] and now - _state["since"] >= MIN_LITE_SECONDS
+              and queue_depth <= EXIT_QUEUE_DEPTH and (slowdown is None or slowdown <= EXIT_SLOWDOWN)):
+            logger.warning("Leaving lite mode after %.0fs", now - _state["since"])
+            _state.update(lite=False, since=now, reason=None)
+            _stats["left"] += 1
+        return _state["lite"]
+
+
+def chat_max_tokens():
+    """
+    Returns the reply length cap for chat calls, or None when there is none.
+    """
+    return CHAT_MAX_TOKENS_LITE if is_lite() else None
+
+
+def get_stats():
+    with _lock:
+        return {
+            "mode": "lite" if _state["lite"] else "full",
+            "seconds_in_mode": round(time.monotonic() - _state["since"]),
+            "reason": _state["reason"],
+            "queue_depth": _state["queue_depth"],
+            "slowdown": _state["slowdown"],
+            **_stats,
+        }
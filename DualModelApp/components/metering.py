@@ -0,0 +1,247 @@
+import csv
+import io
+import threading
+import time
+from contextlib import contextmanager
+from components import rate_limits, request_context
+
+# Estimated USD per million input and output tokens. Tuned Gemini models are
+# billed at their base model's rate. Search calls are priced per request.
+PRICES = {
+    ("openai", "gpt-4o"): {"input": 2.50, "output": 10.00},
+    ("openai", "gpt-4o-2024-08-06"): {"input": 2.50, "output": 10.00},
+    ("openai", "gpt-3.5-turbo"): {"input": 0.50, "output": 1.50},
+    ("gemini", "gemini-pro"): {"input": 0.50, "output": 1.50},
+    ("gemini", "tunedModels/food-suggestion-ai-v1-uss801z982xp"): {"input": 0.50, "output": 1.50},
+    ("gemini", "tunedModels/food-suggestion-ai-v3-t2z0eh7qpaq8"): {"input": 0.50, "output": 1.50},
+    ("gemini", "tunedModels/food-chatbot-v2-471btbzagxuv"): {"input": 0.50, "output": 1.50},
+    ("gemini", "tunedModels/for-food-image-to-text-v1-9kiq0o2clyrn"): {"input": 0.50, "output": 1.50},
+    ("google", "customsearch"): {"request": 0.005},
+    ("unsplash", "search"): {"request": 0.0},
+}
+FALLBACK_PRICE = {"input": 2.50, "output": 10.00}
+
+# Daily spending limits in USD. Past DOWNGRADE_SHARE of a limit, requests get
+# the cheaper path (compact plans, short chat replies); past the limit they are
+# turned away until the next day. None means no limit.
+SESSION_DAILY_BUDGET = 0.50
+DAILY_BUDGET = 50.0
+DOWNGRADE_SHARE = 0.8
+DOWNGRADED_CHAT_MAX_TOKENS = 256
+
+# Days of totals kept in memory
+DAYS_KEPT = 7
+
+_lock = threading.Lock()
+_totals = {}    # (day, feature, provider, model) -> counters
+_sessions = {}  # (day, session_id) -> counters
+_stats = {"throttled": 0, "downgraded": 0, "not_sent": 0}
+
+
+class BudgetExceeded(rate_limits.RateLimitExceeded):
+    """Raised before a provider call when the session or the whole service is over its daily budget."""
+
+
+def _today():
+    return time.strftime("%Y-%m-%d")
+
+
+def _counters():
+    return {"calls": 0, "failed_calls": 0, "input_tokens": 0, "output_tokens": 0, "images": 0, "seconds": 0.0,
+            "failed_seconds": 0.0, "cost_usd": 0.0}
+
+
+def _cost(provider, model, input_tokens, output_tokens):
+    price = PRICES.get((provider, model), FALLBACK_PRICE)
+    if "request" in price:
+        return price["request"]
+    return (input_tokens * price["input"] + output_tokens * price["output"]) / 1_000_000
+
+
+def configure(session_daily_budget=None, daily_budget=None):
+    """
+    Sets the daily USD budgets per session and for the whole service. None
+    removes that limit.
+    """
+    global SESSION_DAILY_BUDGET, DAILY_BUDGET
+    with _lock:
+        SESSION_DAILY_BUDGET = session_daily_budget
+        DAILY_BUDGET = daily_budget
+
+
+def _spent(day, session_id):
+    # Runs with _lock held
+    session = _sessions.get((day, session_id), {}).get("cost_usd", 0.0)
+    service = sum(c["cost_usd"] for key, c in _sessions.items() if key[0] == day)
+    return session, service
+
+
+def _share_used(session_id):
+    # Runs with _lock held. The larger of the session's and the service's share of budget used.
+    session, service = _spent(_today(), session_id)
+    shares = [0.0]
+    if SESSION_DAILY_BUDGET and session_id is not None:
+        shares.append(session / SESSION_DAILY_BUDGET)
+    if DAILY_BUDGET:
+        shares.append(service / DAILY_BUDGET)
+    return max(shares)
+
+
+def enforce():
+    """
+    Raises BudgetExceeded if the current session or the whole service has used
+    up today's budget.
+    """
+    session_id = request_context.get("session_id")
+    with _lock:
+        if _share_used(session_id) < 1.0:
+            return
+        _stats["throttled"] += 1
+    raise BudgetExceeded("You've reached today's usage limit for SarrMal. Please come back tomorrow.")
+
+
+def should_downgrade():
+    """
+    Returns True when the current session or the service is close to its daily
+    budget, so callers should pick the cheaper way of answering.
+    """
+    session_id = request_context.get("session_id")
+    with _lock:
+        downgrade = _share_used(session_id) >= DOWNGRADE_SHARE
+        if downgrade:
+            _stats["downgraded"] += 1
+        return downgrade
+
+
+def chat_max_tokens():
+    """
+    Returns the reply length cap for chat calls near the budget, or None.
+    """
+    return DOWNGRADED_CHAT_MAX_TOKENS if should_downgrade() else None
+
+
+class _Usage:
+    def __init__(self, input_tokens):
+        self.input_tokens = input_tokens
+        self.output_tokens = 0
+        self.sent_at = None
+
+    def sending(self):
+        """Marks the moment the request goes to the provider, after any queueing."""
+        self.sent_at = time.monotonic()
+
+    def set_response(self, response):
+        """Takes the token counts the provider reported, where it reports them."""
+        usage = response.get("usage") if isinstance(response, dict) else None
+        if usage:  # OpenAI
+            self.input_tokens = usage.get("prompt_tokens", self.input_tokens)
+            self.output_tokens = usage.get("completion_tokens", 0)
+            return
+        metadata = getattr(response, "usage_metadata", None)
+        if metadata is not None:  # Gemini
+            self.input_tokens = getattr(metadata, "prompt_token_count", 0) or self.input_tokens
+            self.output_tokens = getattr(metadata, "candidates_token_count", 0) or 0
+
+
+@contextmanager
+def meter(provider, model, feature, input_text="", images=0):
+    """
+    Checks the budget, then records the call made inside the block: tokens,
+    images, latency and estimated cost, labelled by feature, model and session.
+    The block calls `usage.sending()` just before the request goes out, and
+    passes the provider's response to `usage.set_response`; without it, input
+    tokens are estimated from `input_text`.
+
+    Only calls that were sent are recorded, timed from `sending()`, so breaker,
+    queue and rate-limit rejections and waits aren't charged. Sent calls that
+    raise count as failed calls, apart from answered ones and not charged.
+
+    Example:
+        with metering.meter("openai", model, "chat", str(messages)) as usage:
+            usage.sending()
+            usage.set_response(openai.ChatCompletion.create(...))
+
+    Raises:
+    - BudgetExceeded: Before the call, if today's budget is used up.
+    """
+    enforce()
+    feature = request_context.get("feature") or feature
+    session_id = request_context.get("session_id")
+    usage = _Usage(rate_limits.estimate_tokens(input_text) if input_text else 0)
+    answered = False
+    try:
+        yield usage
+        answered = True
+    finally:
+        if usage.sent_at is None:
+            with _lock:
+                _stats["not_sent"] += 1
+        else:
+            _record(feature, provider, model, session_id, usage, images, answered)
+
+
+def _record(feature, provider, model, session_id, usage, images, answered):
+    seconds = time.monotonic() - usage.sent_at
+    day = _today()
+    with _lock:
+        for counters in (
+            _totals.setdefault((day, feature, provider, model), _counters()),
+            _sessions.setdefault((day, session_id), _counters()),
+        ):
+            if answered:
+                counters["calls"] += 1
+                counters["input_tokens"] += usage.input_tokens
+                counters["output_tokens"] += usage.output_tokens
+                counters["images"] += images
+                counters["seconds"] += seconds
+                counters["cost_usd"] += _cost(provider, model, usage.input_tokens, usage.output_tokens)
+            else:
+                counters["failed_calls"] += 1
+                counters["failed_seconds"] += seconds
+        days = sorted({key[0] for key in _totals})
+        for old_day in days[:-DAYS_KEPT]:
+            for store in (_totals, _sessions):
+                for key in [k for k in store if k[0] == old_day]:
+                    del store[key]
+
+
+def get_stats():
+    """
+    Returns today's totals per feature and model, the number of sessions, the
+    heaviest sessions and how often budgets throttled or downgraded requests.
+    """
+    day = _today()
+    with _lock:
+        features = {
+            f"{feature} / {model}": {**counters, "cost_usd": round(counters["cost_usd"], 4),
+                                     "seconds": round(counters["seconds"], 1),
+                                     "failed_seconds": round(counters["failed_seconds"], 1)}
+            for (totals_day, feature, _, model), counters in _totals.items() if totals_day == day
+        }
+        sessions = sorted(
+            ((session_id, c["cost_usd"]) for (d, session_id), c in _sessions.items() if d == day),
+            key=lambda item: item[1], reverse=True,
+        )
+        return {
+            "day": day,
+            "by_feature_and_model": features,
+            "cost_usd": round(sum(cost for _, cost in sessions), 4),
+            "sessions": len(sessions),
+            "top_sessions_usd": {str(session_id)[:8]: round(cost, 4) for session_id, cost in sessions[:5]},
+            **_stats,
+        }
+
+
+def export_csv():
+    """
+    Returns every kept day's totals per feature and model as CSV, for capacity planning.
+    """
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(["day", "feature", "provider", "model", "calls", "failed_calls", "input_tokens", "output_tokens",
+                     "images", "seconds", "cost_usd"])
+    with _lock:
+        for (day, feature, provider, model), c in sorted(_totals.items()):
+            writer.writerow([day, feature, provider, model, c["calls"], c["failed_calls"], c["input_tokens"], c["output_tokens"],
+                             c["images"], round(c["seconds"], 1), round(c["cost_usd"], 6)])
+    return output.getvalue()
@@ -0,0 +1,77 @@
+import numpy as np
+
+# Multipliers on BMR for the form's exercise levels ("High" is used by the few-shot example)
+ACTIVITY_FACTORS = {"None": 1.2, "Light": 1.375, "Moderate": 1.55, "Intense": 1.725, "High": 1.725}
+DEFAULT_ACTIVITY_FACTOR = 1.375
+
+# Mifflin-St Jeor constant per gender, "Other" sits halfway between the two
+GENDER_CONSTANTS = {"Male": 5.0, "Female": -161.0, "Other": -78.0}
+
+# Share of daily energy from each macro, and the kcal per gram used to convert
+MACRO_SPLIT = {"protein": 0.20, "fat": 0.30, "carbs": 0.50}
+DIABETES_MACRO_SPLIT = {"protein": 0.25, "fat": 0.35, "carbs": 0.40}
+KCAL_PER_GRAM = {"protein": 4.0, "fat": 9.0, "carbs": 4.0}
+
+# A plan further than this from the target is treated as clearly wrong
+CALORIE_TOLERANCE = 0.5
+
+
+def daily_targets_batch(profiles):
+    """
+    Computes energy and macro targets for many profiles at once.
+
+    Parameters:
+    - profiles (list): Profile dicts with weight (kg), height (cm), age, gender,
+      exercise and optionally diseases.
+
+    Returns:
+    - dict: numpy arrays "bmr", "calories", "protein_g", "fat_g" and "carbs_g",
+      one entry per profile.
+    """
+    weight = np.array([float(p["weight"]) for p in profiles])
+    height = np.array([float(p["height"]) for p in profiles])
+    age = np.array([float(p["age"]) for p in profiles])
+    constant = np.array([GENDER_CONSTANTS.get(p.get("gender"), GENDER_CONSTANTS["Other"]) for p in profiles])
+    activity = np.array([ACTIVITY_FACTORS.get(p.get("exercise"), DEFAULT_ACTIVITY_FACTOR) for p in profiles])
+    diabetic = np.array(["Diabetes" in p.get("diseases", []) for p in profiles])
+
+    bmr = 10.0 * weight + 6.25 * height - 5.0 * age + constant
+    calories = np.round(bmr * activity, -1)  # nearest 10 kcal is precise enough for a plan
+    targets = {"bmr": np.round(bmr), "calories": calories}
+    for macro in MACRO_SPLIT:
+        share = np.where(diabetic, DIABETES_MACRO_SPLIT[macro], MACRO_SPLIT[macro])
+        targets[f"{macro}_g"] = np.round(calories * share / KCAL_PER_GRAM[macro])
+    return targets
+
+
+def daily_targets(profile):
+    """
+    Returns the energy and macro targets for one profile as plain numbers.
+    """
+    return {name: int(values[0]) for name, values in daily_targets_batch([profile]).items()}
+
+
+def plan_calories(plan):
+    """
+    Returns the total calories of every dish in a meal plan.
+    """
+    total = 0
+    for meal in plan.get("response", {}).values():
+        for dish in (meal or {}).values():
+            calories = dish.get("calories") if isinstance(dish, dict) else None
+            if isinstance(calories, (int, float)):
+                total += calories
+    return total
+
+
+def check_plan(plan, target_calories, tolerance=CALORIE_TOLERANCE):
+    """
+    Checks a plan's total calories against the computed daily target.
+
+    Returns:
+    - str: A description of the problem, or None if the plan is within tolerance.
+    """
+    total = plan_calories(plan)
+    if target_calories and abs(total - target_calories) > tolerance * target_calories:
+        return f"the plan adds up to {total} kcal against a daily target of {target_calories} kcal"
+    return None
@@ -0,0 +1,172 @@
+import threading
+import time
+from collections import deque
+from components import request_context
+
+# Requests-per-minute and tokens-per-minute budgets shared by every Streamlit
+# session in this process. Keep them a little under the provider quotas.
+DEFAULT_LIMITS = {
+    ("openai", "gpt-4o"): {"rpm": 400, "tpm": 25000},
+    ("openai", "gpt-4o-2024-08-06"): {"rpm": 400, "tpm": 25000},
+    ("openai", "gpt-3.5-turbo"): {"rpm": 3000, "tpm": 150000},
+    ("gemini", "gemini-pro"): {"rpm": 50, "tpm": 30000},
+    ("gemini", "tunedModels/food-suggestion-ai-v1-uss801z982xp"): {"rpm": 50, "tpm": 30000},
+    ("gemini", "tunedModels/food-suggestion-ai-v3-t2z0eh7qpaq8"): {"rpm": 50, "tpm": 30000},
+    ("gemini", "tunedModels/for-food-image-to-text-v1-9kiq0o2clyrn"): {"rpm": 50, "tpm": 30000},
+    ("gemini", "tunedModels/food-chatbot-v2-471btbzagxuv"): {"rpm": 50, "tpm": 30000},
+    ("unsplash", "search"): {"rpm": 45, "tpm": None},
+    ("google", "customsearch"): {"rpm": 90, "tpm": None},
+}
+# Used for any provider/model without its own entry
+FALLBACK_LIMIT = {"rpm": 60, "tpm": None}
+
+# How long a caller waits for capacity before giving up
+MAX_WAIT_SECONDS = 10.0
+# Rough size of a token for English text, good enough for budgets and estimates
+CHARS_PER_TOKEN = 4
+
+
+class RateLimitExceeded(Exception):
+    """Raised when no capacity frees up within the wait limit."""
+
+
+def estimate_tokens(text, max_output_tokens=0):
+    """
+    Returns the estimated tokens of a text, plus the output tokens a call may add.
+    Used wherever tokens are counted before (or without) a provider's count.
+    """
+    return len(text or "") // CHARS_PER_TOKEN + max_output_tokens
+
+
+class TokenBucket:
+    """
+    Refills `rate_per_minute` units evenly over a minute, holding at most one
+    minute's worth. A rate of None means unlimited.
+    """
+
+    def __init__(self, rate_per_minute):
+        self.rate = rate_per_minute
+        self.capacity = rate_per_minute
+        self.level = rate_per_minute
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        if self.rate is None:
+            return
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate / 60.0)
+        self.updated = now
+
+    def wait_for(self, amount):
+        # Seconds until `amount` units are available (0 if they are now)
+        if self.rate is None:
+            return 0.0
+        amount = min(amount, self.capacity)  # an oversized request waits for a full bucket
+        return max(0.0, (amount - self.level) * 60.0 / self.rate)
+
+    def take(self, amount):
+        if self.rate is not None:
+            self.level -= min(amount, self.capacity)
+
+
+class _Limiter:
+    def __init__(self, rpm, tpm):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.lock = threading.Lock()
+        self.waits = deque(maxlen=1000)
+        self.total_requests = 0
+        self.rejected = 0
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def _limiter(provider, model):
+    key = (provider, model)
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limits = DEFAULT_LIMITS.get(key, FALLBACK_LIMIT)
+            limiter = _limiters[key] = _Limiter(limits["rpm"], limits["tpm"])
+        return limiter
+
+
+def configure(provider, model, rpm=None, tpm=None):
+    """
+    Sets the requests-per-minute and tokens-per-minute budget for a provider
+    and model. None leaves that dimension unlimited.
+    """
+    with _limiters_lock:
+        DEFAULT_LIMITS[(provider, model)] = {"rpm": rpm, "tpm": tpm}
+        _limiters.pop((provider, model), None)
+
+
+def acquire(provider, model, tokens=0, max_wait=MAX_WAIT_SECONDS):
+    """
+    Blocks until the provider/model budget has room for one request of
+    `tokens` tokens, then reserves it.
+
+    Parameters:
+    - provider (str): e.g. "openai", "gemini", "unsplash", "google".
+    - model (str): The model name or endpoint.
+    - tokens (int): Estimated prompt plus completion tokens.
+    - max_wait (float): Seconds to wait before giving up.
+
+    Returns:
+    - float: Seconds spent waiting in the queue.
+
+    Raises:
+    - RateLimitExceeded: If capacity doesn't free up within max_wait.
+    - request_context.Cancelled: If the request is cancelled while waiting.
+    - request_context.DeadlineExceeded: If the request's deadline comes first.
+    """
+    left = request_context.remaining()
+    if left is not None:
+        max_wait = min(max_wait, left)
+    limiter = _limiter(provider, model)
+    started = time.monotonic()
+    while True:
+        with limiter.lock:
+            now = time.monotonic()
+            limiter.requests.refill(now)
+            limiter.tokens.refill(now)
+            delay = max(limiter.requests.wait_for(1), limiter.tokens.wait_for(tokens))
+            waited = now - started
+            if delay == 0:
+                limiter.requests.take(1)
+                limiter.tokens.take(tokens)
+                limiter.total_requests += 1
+                limiter.waits.append(waited)
+                return waited
+            if waited + delay > max_wait:
+                limiter.rejected += 1
+                if left is not None and max_wait == left:
+                    raise request_context.DeadlineExceeded("The request ran out of time")
+                raise RateLimitExceeded(
+                    f"The {provider} service is busy right now. Please try again in a moment."
+                )
+        request_context.raise_if_cancelled()
+        time.sleep(min(delay, 0.25))
+
+
+def get_wait_stats():
+    """
+    Returns queue wait statistics per "provider/model": requests admitted,
+    requests rejected, and mean, p95 and max wait in seconds.
+    """
+    with _limiters_lock:
+        items = list(_limiters.items())
+    stats = {}
+    for (provider, model), limiter in items:
+        with limiter.lock:
+            waits = sorted(limiter.waits)
+            total, rejected = limiter.total_requests, limiter.rejected
+        stats[f"{provider}/{model}"] = {
+            "requests": total,
+            "rejected": rejected,
+            "mean_wait": sum(waits) / len(waits) if waits else 0.0,
+            "p95_wait": waits[int(0.95 * (len(waits) - 1))] if waits else 0.0,
+            "max_wait": waits[-1] if waits else 0.0,
+        }
+    return stats
@@ -0,0 +1,105 @@
+import contextvars
+import time
+from contextlib import contextmanager
+
+# Per-request values the components read without threading them through every
+# call: who is asking, how to tell them they are waiting in a queue, whether
+# they have given up on the request, when the answer is due (a
+# time.monotonic() value), and which feature usage is metered under.
+_VARS = {
+    "session_id": contextvars.ContextVar("session_id", default=None),
+    "on_queue_wait": contextvars.ContextVar("on_queue_wait", default=None),
+    "cancel_event": contextvars.ContextVar("cancel_event", default=None),
+    "deadline": contextvars.ContextVar("deadline", default=None),
+    "feature": contextvars.ContextVar("feature", default=None),
+}
+
+# A provider call is not started with less time than this left
+MIN_CALL_SECONDS = 1.0
+
+
+class Cancelled(Exception):
+    """Raised when the request's cancel_event is set, e.g. a background job was cancelled."""
+
+
+class DeadlineExceeded(Cancelled):
+    """Raised when the request has run out of time before a call could start."""
+
+
+def get(name):
+    return _VARS[name].get()
+
+
+@contextmanager
+def use(**values):
+    """
+    Sets request values for the calls made inside the block.
+
+    Example:
+        with request_context.use(session_id=st.session_state.session_id):
+            food_suggestions.generate_gemini_v3(prompt)
+    """
+    tokens = [(_VARS[name], _VARS[name].set(value)) for name, value in values.items()]
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+def remaining():
+    """
+    Returns the seconds left before the request's deadline, or None if it has none.
+    """
+    deadline = _VARS["deadline"].get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def timeout(default=None):
+    """
+    Returns the timeout for a provider call: the time left before the deadline,
+    or `default` when the request has none.
+
+    Raises:
+    - DeadlineExceeded: If too little time is left to make the call.
+    """
+    left = remaining()
+    if left is None:
+        return default
+    if left < MIN_CALL_SECONDS:
+        raise DeadlineExceeded("The request ran out of time")
+    return left
+
+
+@contextmanager
+def stage(share):
+    """
+    Gives the block `share` (0-1) of the time left, so one slow stage can't use
+    up the time the later ones need. Without a deadline this does nothing.
+
+    Example:
+        with request_context.use(deadline=time.monotonic() + 45):
+            with request_context.stage(0.7):
+                plan = food_suggestions.generate_gemini_v3(prompt)
+            # pictures get what is left
+    """
+    left = remaining()
+    if left is None:
+        yield
+        return
+    with use(deadline=time.monotonic() + max(left, 0.0) * share):
+        yield
+
+
+def raise_if_cancelled():
+    """
+    Raises Cancelled if the current request has been cancelled, or
+    DeadlineExceeded if its deadline has passed. Called before and while waiting
+    for provider capacity, so abandoned and overdue requests give it up.
+    """
+    event = _VARS["cancel_event"].get()
+    if event is not None and event.is_set():
+        raise Cancelled("The request was cancelled")
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded("The request ran out of time")
@@ -0,0 +1,126 @@
+import random
+import threading
+import time
+from collections import deque
+from components import circuit_breaker
+
+# The backends that can serve each feature, and the model whose latency stands
+# for each. Only backends listed here are candidates, so a feature never goes
+# to a model that can't do it well (photos stay on the vision model).
+BACKENDS = {
+    "meal_plan": {
+        "sarrmal": ("gemini", "tunedModels/food-suggestion-ai-v3-t2z0eh7qpaq8"),
+        "openai": ("openai", "gpt-4o-2024-08-06"),
+    },
+    "chat": {
+        "sarrmal": ("gemini", "tunedModels/food-chatbot-v2-471btbzagxuv"),
+        "openai": ("openai", "gpt-3.5-turbo"),
+    },
+    "photo": {
+        "openai": ("openai", "gpt-4o"),
+    },
+}
+
+# Calls remembered per model, and how old they may be before they stop counting
+WINDOW_SIZE = 100
+WINDOW_SECONDS = 600.0
+# A backend needs this many recent calls before its numbers are trusted
+MIN_SAMPLES = 5
+# Share of auto requests sent to a backend other than the fastest, to keep its numbers fresh
+EXPLORE_SHARE = 0.1
+# Backends failing more often than this are left out while another one is usable
+MAX_ERROR_RATE = 0.5
+
+_lock = threading.Lock()
+_calls = {}
+_decisions = {}
+
+
+def record(provider, model, seconds, ok):
+    """
+    Records one provider call. Called by circuit_breaker.guard for every call
+    that reached the provider.
+    """
+    with _lock:
+        calls = _calls.get((provider, model))
+        if calls is None:
+            calls = _calls[(provider, model)] = deque(maxlen=WINDOW_SIZE)
+        calls.append((time.monotonic(), seconds, ok))
+
+
+def percentile(values, fraction):
+    """
+    Returns the value at `fraction` (0-1) of the sorted values, or 0.0 if there are none.
+    """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def _summary(provider, model, now):
+    # Runs with _lock held
+    recent = [c for c in _calls.get((provider, model), ()) if now - c[0] <= WINDOW_SECONDS]
+    latencies = [seconds for _, seconds, ok in recent if ok]
+    return {
+        "samples": len(recent),
+        "p50": round(percentile(latencies, 0.5), 3) if latencies else None,
+        "p95": round(percentile(latencies, 0.95), 3) if latencies else None,
+        "error_rate": sum(1 for _, _, ok in recent if not ok) / len(recent) if recent else 0.0,
+    }
+
+
+def _expected_seconds(summary):
+    # Median time to a good answer, counting the retries that errors cost
+    return summary["p50"] / (1.0 - min(summary["error_rate"], 0.9))
+
+
+def choose(feature):
+    """
+    Picks the backend for one "auto" request: the one expected to answer
+    fastest, a backend without enough recent calls to judge, or now and then
+    (EXPLORE_SHARE) another usable one.
+
+    Parameters:
+    - feature (str): "meal_plan", "chat" or "photo".
+
+    Returns:
+    - str: The backend name, "sarrmal" or "openai".
+    """
+    backends = BACKENDS[feature]
+    usable = [name for name, option in backends.items() if circuit_breaker.can_route(*option)]
+    if not usable:
+        usable = list(backends)  # everything is failing, let the call report it
+    now = time.monotonic()
+    with _lock:
+        summaries = {name: _summary(*backends[name], now) for name in usable}
+        healthy = [name for name in usable if summaries[name]["error_rate"] <= MAX_ERROR_RATE] or usable
+        unmeasured = [
+            name for name in healthy
+            if summaries[name]["samples"] < MIN_SAMPLES or summaries[name]["p50"] is None
+        ]
+        if unmeasured:
+            choice, reason = random.choice(unmeasured), "measuring"
+        else:
+            fastest = min(healthy, key=lambda name: _expected_seconds(summaries[name]))
+            others = [name for name in healthy if name != fastest]
+            if others and random.random() < EXPLORE_SHARE:
+                choice, reason = random.choice(others), "exploring"
+            else:
+                choice, reason = fastest, "fastest"
+        counts = _decisions.setdefault(feature, {})
+        counts[f"{choice} ({reason})"] = counts.get(f"{choice} ({reason})", 0) + 1
+    return choice
+
+
+def get_stats():
+    """
+    Returns rolling p50/p95 latency, error rate and sample count per model, and
+    how auto requests were routed per feature.
+    """
+    now = time.monotonic()
+    with _lock:
+        return {
+            "models": {f"{provider} {model}": _summary(provider, model, now) for provider, model in _calls},
+            "auto_decisions": {feature: dict(counts) for feature, counts in _decisions.items()},
+        }
@@ -0,0 +1,166 @@
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from components import request_context, rate_limits
+
+# How many calls may be in flight to each provider at once, across all sessions
+PROVIDER_CONCURRENCY = {"openai": 8, "gemini": 4, "unsplash": 4, "google": 4}
+DEFAULT_CONCURRENCY = 4
+
+# Lanes are served by queue time plus a head start, so chat replies jump ahead
+# of photo and meal plan work without starving them.
+LANE_HEAD_START_SECONDS = {"chat": 0.0, "photo": 2.0, "meal_plan": 5.0}
+
+# Waiting calls allowed per provider and lane before new ones are turned away
+MAX_QUEUED = {"chat": 20, "photo": 20, "meal_plan": 30}
+MAX_QUEUE_WAIT_SECONDS = 60.0
+
+LANE_LABELS = {"chat": "chat", "photo": "photo detection", "meal_plan": "meal plan"}
+
+
+class SchedulerFull(rate_limits.RateLimitExceeded):
+    """Raised when a lane's queue is full or a call waited too long for a slot."""
+
+
+class _Ticket:
+    def __init__(self, lane, session_id, seq):
+        self.lane = lane
+        self.session_id = session_id
+        self.enqueued_at = time.monotonic()
+        self.order = (self.enqueued_at + LANE_HEAD_START_SECONDS[lane], seq)
+
+
+class _ProviderQueue:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.running = 0
+        self.waiting = []
+        self.admitted = 0
+        self.rejected = 0
+
+
+_queues = {}
+_seq = itertools.count()
+_cond = threading.Condition()
+
+
+def _queue(provider):
+    queue = _queues.get(provider)
+    if queue is None:
+        queue = _queues[provider] = _ProviderQueue(PROVIDER_CONCURRENCY.get(provider, DEFAULT_CONCURRENCY))
+    return queue
+
+
+def _position(queue, ticket):
+    return sum(1 for other in queue.waiting if other.order < ticket.order) + 1
+
+
+@contextmanager
+def admit(provider, lane):
+    """
+    Holds one of the provider's concurrency slots for the duration of the block,
+    queueing behind other callers when all slots are taken.
+
+    Parameters:
+    - provider (str): e.g. "openai", "gemini", "unsplash", "google".
+    - lane (str): "chat", "photo" or "meal_plan".
+
+    Raises:
+    - SchedulerFull: If the lane's queue is full or no slot frees up in time.
+    - request_context.Cancelled: If the request is cancelled, or its deadline
+      passes, before it gets a slot.
+    """
+    request_context.raise_if_cancelled()
+    session_id = request_context.get("session_id")
+    on_wait = request_context.get("on_queue_wait")
+    with _cond:
+        queue = _queue(provider)
+        if queue.running < queue.capacity and not queue.waiting:
+            queue.running += 1
+            queue.admitted += 1
+            ticket = None
+        else:
+            if sum(1 for t in queue.waiting if t.lane == lane) >= MAX_QUEUED[lane]:
+                queue.rejected += 1
+                raise SchedulerFull(
+                    f"Too many {LANE_LABELS[lane]} requests are waiting right now. Please try again in a minute."
+                )
+            ticket = _Ticket(lane, session_id, next(_seq))
+            queue.waiting.append(ticket)
+
+    if ticket is not None:
+        _wait_for_slot(queue, ticket, on_wait)
+    try:
+        yield
+    finally:
+        with _cond:
+            queue.running -= 1
+            _cond.notify_all()
+
+
+def _wait_for_slot(queue, ticket, on_wait):
+    last_position = None
+    try:
+        while True:
+            with _cond:
+                request_context.raise_if_cancelled()
+                position = _position(queue, ticket)
+                if position == 1 and queue.running < queue.capacity:
+                    queue.waiting.remove(ticket)
+                    queue.running += 1
+                    queue.admitted += 1
+                    _cond.notify_all()
+                    return
+                if time.monotonic() - ticket.enqueued_at > MAX_QUEUE_WAIT_SECONDS:
+                    queue.rejected += 1
+                    raise SchedulerFull(
+                        f"The {LANE_LABELS[ticket.lane]} queue is moving slowly right now. Please try again in a minute."
+                    )
+                _cond.wait(timeout=0.5)
+                position = _position(queue, ticket)
+            # The callback may draw on the page, so call it without holding the lock
+            if on_wait is not None and position != last_position:
+                on_wait(position)
+                last_position = position
+    except BaseException:
+        # Cancelled, timed out, or interrupted in the callback (Streamlit stops a
+        # script mid-wait on any click): give the place in line up, or it blocks
+        # every later caller
+        with _cond:
+            if ticket in queue.waiting:
+                queue.waiting.remove(ticket)
+            _cond.notify_all()
+        raise
+
+
+def queue_position(session_id):
+    """
+    Returns the best (lowest) queue position of the user's waiting calls, or
+    None if nothing of theirs is waiting.
+    """
+    with _cond:
+        positions = [
+            _position(queue, ticket)
+            for queue in _queues.values()
+            for ticket in queue.waiting
+            if ticket.session_id == session_id
+        ]
+    return min(positions) if positions else None
+
+
+def get_stats():
+    """
+    Returns per-provider running and waiting counts, with waiting broken down by lane.
+    """
+    with _cond:
+        return {
+            provider: {
+                "running": queue.running,
+                "capacity": queue.capacity,
+                "waiting": {lane: sum(1 for t in queue.waiting if t.lane == lane) for lane in MAX_QUEUED},
+                "admitted": queue.admitted,
+                "rejected": queue.rejected,
+            }
+            for provider, queue in _queues.items()
+        }
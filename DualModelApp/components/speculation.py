@@ -0,0 +1,164 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from components import request_context
+
+# Inputs must stay unchanged this long before a plan is generated speculatively
+DEBOUNCE_SECONDS = 3.0
+# Speculative generations allowed per session, so idle form-fiddling has a cost cap
+MAX_SPECULATIONS_PER_SESSION = 5
+# How long a click waits for a speculation that is still running
+TAKE_TIMEOUT_SECONDS = 60.0
+# Sessions whose form hasn't been seen for this long are dropped, with their plan
+SESSION_IDLE_SECONDS = 30 * 60
+
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="speculation")
+_lock = threading.RLock()  # a finished future runs its callback inline, inside _start
+_sessions = {}
+_stats = {"started": 0, "hits": 0, "misses": 0, "discarded": 0, "cancelled": 0, "over_budget": 0, "expired": 0}
+
+
+class _Speculation:
+    def __init__(self):
+        self.key = None       # the inputs the user has now
+        self.timer = None
+        self.future = None    # at most one generation in flight per session
+        self.future_key = None
+        self.pending = False  # the debounce fired while another generation was running
+        self.started = 0
+        self.call = None
+        self.cancel_event = None  # stops the generation in flight once its inputs are stale
+        self.last_seen = time.monotonic()
+
+
+def _start(session_id, spec):
+    # Runs with _lock held
+    if spec.started >= MAX_SPECULATIONS_PER_SESSION:
+        _stats["over_budget"] += 1
+        return
+    generate, args = spec.call
+    spec.started += 1
+    spec.future_key = spec.key
+    spec.pending = False
+    _stats["started"] += 1
+    cancel_event = spec.cancel_event = threading.Event()
+
+    def run():
+        with request_context.use(session_id=session_id, cancel_event=cancel_event):
+            return generate(*args)
+
+    spec.future = _executor.submit(run)
+    spec.future.add_done_callback(lambda future: _finished(session_id, future))
+
+
+def _finished(session_id, future):
+    with _lock:
+        spec = _sessions.get(session_id)
+        if spec is None or spec.future is not future:
+            return  # already handed out by take()
+        if spec.future_key != spec.key:
+            _stats["discarded"] += 1
+            spec.future = spec.future_key = None
+            if spec.pending:
+                _start(session_id, spec)
+
+
+def _fire(session_id, key):
+    with _lock:
+        spec = _sessions.get(session_id)
+        if spec is None or spec.key != key:
+            return
+        if spec.future is not None and not spec.future.done():
+            spec.pending = True  # start once the running one finishes
+        else:
+            _start(session_id, spec)
+
+
+def _drop(session_id):
+    # Runs with _lock held
+    spec = _sessions.pop(session_id, None)
+    if spec is not None:
+        if spec.timer is not None:
+            spec.timer.cancel()
+        if spec.cancel_event is not None:
+            spec.cancel_event.set()
+    return spec
+
+
+def _prune(now):
+    # Runs with _lock held
+    for session_id, spec in list(_sessions.items()):
+        if now - spec.last_seen > SESSION_IDLE_SECONDS:
+            _drop(session_id)
+            _stats["expired"] += 1
+
+
+def observe(session_id, key, generate, *args):
+    """
+    Called on every rerun with the current form inputs. Once the inputs have
+    stayed the same for DEBOUNCE_SECONDS, `generate(*args)` starts in the
+    background; a change of inputs makes any earlier speculation stale.
+
+    Parameters:
+    - session_id (str): The Streamlit session.
+    - key (hashable): Identifies the inputs, e.g. (prompt, plan format, model).
+    - generate (callable): The generation function to run.
+    """
+    now = time.monotonic()
+    with _lock:
+        _prune(now)
+        spec = _sessions.setdefault(session_id, _Speculation())
+        spec.last_seen = now
+        if spec.key == key:
+            return
+        spec.key = key
+        spec.call = (generate, args)
+        spec.pending = False
+        if spec.timer is not None:
+            spec.timer.cancel()
+        if spec.future is not None and spec.future_key != key:
+            if spec.future.cancel():
+                _stats["discarded"] += 1
+                spec.future = spec.future_key = None
+            elif not spec.future.done():
+                # Already generating for the old inputs: stop it so it frees its provider slot
+                spec.cancel_event.set()
+                _stats["cancelled"] += 1
+        spec.timer = threading.Timer(DEBOUNCE_SECONDS, _fire, args=(session_id, key))
+        spec.timer.daemon = True
+        spec.timer.start()
+
+
+def take(session_id, key, timeout=TAKE_TIMEOUT_SECONDS):
+    """
+    Returns the speculative result for these inputs, waiting for it if it is
+    still being generated, or None if there is none (the caller then generates
+    as usual). A result is handed out once.
+    """
+    with _lock:
+        spec = _sessions.get(session_id)
+        if spec is not None:
+            spec.last_seen = time.monotonic()
+        if spec is None or spec.future is None or spec.future_key != key:
+            _stats["misses"] += 1
+            return None
+        future = spec.future
+        # Handed out once; the key stays so the same inputs aren't speculated on again
+        spec.future = spec.future_key = spec.cancel_event = None
+    try:
+        result = future.result(timeout=timeout)
+    except Exception:
+        result = None
+    with _lock:
+        _stats["hits" if result else "misses"] += 1
+    return result
+
+
+def forget(session_id):
+    with _lock:
+        _drop(session_id)
+
+
+def get_stats():
+    with _lock:
+        return {**_stats, "sessions": len(_sessions)}